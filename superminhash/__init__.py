@@ -2,37 +2,66 @@ from __future__ import division, unicode_literals
 
 __all__ = ['utlilits']
 
-import hashlib
+from array import array
 import numpy as np
 import logging
 import collections
+import itertools
 import sys
+import threading
+import time
+
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
 
 if sys.version_info[0] >= 3:
     basestring = str
     unicode = str
     long = int
+    intern = sys.intern
 else:
     range = xrange
 
 try:
-    from utlilits import get_value, simhash_build_by_features, superminhash_build_by_features, MAX_UINT32
+    from utlilits import get_value, simhash_build_by_features, superminhash_build_by_features, MAX_UINT32, \
+        superminhash_push_hashes, superminhash_hash_features, superminhash_signature_matrix, superminhash_features, \
+        superminhash_merge_states, superminhash_cardinality, superminhash_union_cardinality, \
+        superminhash_intersection_cardinality, superminhash_containment, superminhash_weighted_features, \
+        weighted_superminhash_push_hashes, \
+        simhash_push_features, simhash_value, get_features, similarity_matrix, top_k, superminhash_lsh_params, \
+        band_hashes, popcount64, fingerprint_words, bit_count, hamming_search, SIMILARITY_CHUNKSIZE, \
+        HASH_FUNCTIONS, HashFunction, get_hash_function, register_hash_function, \
+        write_store, read_store, pack_ids, StoredIds, hash_function_name, LRUCache, CachedHashFunction, \
+        cached_signatures, IndexMetrics, bucket_stats, words_value, fingerprint_matrix, hamming_distances, \
+        block_bits, shingle_hashes, same_hash_function
 except:
-    from superminhash.utlilits import get_value, simhash_build_by_features, superminhash_build_by_features, MAX_UINT32
+    from superminhash.utlilits import get_value, simhash_build_by_features, superminhash_build_by_features, MAX_UINT32, \
+        superminhash_push_hashes, superminhash_hash_features, superminhash_signature_matrix, superminhash_features, \
+        superminhash_merge_states, superminhash_cardinality, superminhash_union_cardinality, \
+        superminhash_intersection_cardinality, superminhash_containment, superminhash_weighted_features, \
+        weighted_superminhash_push_hashes, \
+        simhash_push_features, simhash_value, get_features, similarity_matrix, top_k, superminhash_lsh_params, \
+        band_hashes, popcount64, fingerprint_words, bit_count, hamming_search, SIMILARITY_CHUNKSIZE, \
+        HASH_FUNCTIONS, HashFunction, get_hash_function, register_hash_function, \
+        write_store, read_store, pack_ids, StoredIds, hash_function_name, LRUCache, CachedHashFunction, \
+        cached_signatures, IndexMetrics, bucket_stats, words_value, fingerprint_matrix, hamming_distances, \
+        block_bits, shingle_hashes, same_hash_function
+
+_hash_function = get_hash_function('md5')
 
-def _hash_function(x):
-    if isinstance(x, str):
-        return int(hashlib.md5(x.encode()).hexdigest(), 16)
-    else:
-        return int(hashlib.md5(x).hexdigest(), 16)
-        
+
+def _cache_key(hash_function):
+    name = hash_function_name(hash_function)
+    return name if name is not None else getattr(hash_function, 'function', hash_function)
 
 
 class Simhash(object):
 
     def __init__(self, value, length=64,
                  reg=r'[\w\u4e00-\u9fcc]+', tokenize_slide_width=4, slide_words_delimiter='',
-                 hash_function=None, log=None):
+                 hash_function=None, log=None, cache=None, compact=False):
         """
         `length` is the dimensions of fingerprints
 
@@ -41,16 +70,22 @@ class Simhash(object):
         object can also be specified (some attempt to handle any letters
         is to specify reg=re.compile(r'\w', re.UNICODE))
         `hash_function` accepts a utf-8 encoded string and returns a unsigned
-        integer in at least `f` bits.
+        integer in at least `f` bits, or is the name of a registered backend
+        (see `utlilits.HASH_FUNCTIONS`: 'md5', the default, or 'splitmix64');
+        backends hash all the features of a document in one call.
+        `cache` is an optional LRUCache (shareable between instances) of the
+        hashes of the features; it is not used by the vectorized backends
+        ('splitmix64'), faster than the lookups.
+        `compact` drops the accumulator `v` once the fingerprint is computed
+        (`push` is then not possible); `masks` is shared by all the Simhash of a length.
         """
 
         self.length = length
         self.value = None
 
-        if hash_function is None:
-            self.hash_function = _hash_function
-        else:
-            self.hash_function = hash_function
+        self.hash_function = get_hash_function(hash_function)
+        if cache is not None:
+            self.hash_function = CachedHashFunction(self.hash_function, cache)
 
         if log is None:
             self.log = logging.getLogger(type(self).__name__.lower())
@@ -59,69 +94,280 @@ class Simhash(object):
 
         self.value, self.v, self.masks = get_value(value, self, simhash_build_by_features,
                                tokenize_args={'reg':reg, 'tokenize_slide_width':tokenize_slide_width, 'slide_words_delimiter':slide_words_delimiter},
-                               kwargs={'hash_function' : self.hash_function, 'push_function' : self._push, 'length' : self.length})
+                               kwargs={'hash_function' : self.hash_function, 'push_function' : self._push_many, 'length' : self.length})
+        if compact:
+            self.v = None
 
-    def _push(self, feature, hash_function, v, masks, length, calc=False):
+    @property
+    def words(self):
+        """
+        fingerprint as an uint64 array of (length + 63) // 64 words, lowest word first
+        """
+        return np.array(fingerprint_words(self.value, self.length), dtype=np.uint64)
 
-        if isinstance(feature, basestring):
-            h = hash_function(feature.encode('utf-8'))
-            w = 1
-        else:
-            assert isinstance(feature, collections.Iterable)
-            h = hash_function(feature[0].encode('utf-8'))
-            w = feature[1]
+    @classmethod
+    def build_many(cls, docs, length=64,
+                   reg=r'[\w\u4e00-\u9fcc]+', tokenize_slide_width=4, slide_words_delimiter='',
+                   hash_function=None, cache=None, doc_cache=None):
+        """
+        `docs` is an iterable of texts or features (anything accepted as `value`)
+        return uint64 array, item n is the fingerprint `value` of docs[n]
+
+        No Simhash objects are created; for `length` above 64 the array has
+        shape (len(docs), (length + 63) // 64), one row of words (lowest first) per doc
+        `cache` is an optional LRUCache of the hashes of the features,
+        `doc_cache` an optional LRUCache of the fingerprints of the texts by digest
+        """
+        hash_function = get_hash_function(hash_function)
+        if cache is not None:
+            hash_function = CachedHashFunction(hash_function, cache)
 
-        for i in range(length):
-            v[i] += w if h & masks[i] else -w
+        tokenize_args = {'reg': reg, 'tokenize_slide_width': tokenize_slide_width,
+                         'slide_words_delimiter': slide_words_delimiter}
+
+        if doc_cache is not None:
+            key_args = ('simhash', length, _cache_key(hash_function), getattr(reg, 'pattern', reg),
+                        tokenize_slide_width, slide_words_delimiter)
+            return cached_signatures(docs, doc_cache, key_args,
+                                     lambda x: cls.build_many(x, length, reg, tokenize_slide_width,
+                                                              slide_words_delimiter, hash_function),
+                                     () if length <= 64 else ((length + 63) // 64,), np.uint64)
+
+        values = [simhash_build_by_features(get_features(doc, tokenize_args), length, hash_function, cls._push_many)[0]
+                  for doc in docs]
+        if length <= 64:
+            return np.array(values, dtype=np.uint64)
+        return fingerprint_matrix(values, length)
+
+    @staticmethod
+    def _push_many(features, hash_function, v, masks, length, calc=False):
+
+        v = simhash_push_features(features, hash_function, v, length)
 
         if calc:
-            value = 0
-            for i in range(length):
-                if v[i] > 0:
-                    value |= masks[i]
-            return value, v
+            return simhash_value(v), v
 
         return None, v
 
+    @staticmethod
+    def _push(feature, hash_function, v, masks, length, calc=False):
+
+        return Simhash._push_many([feature], hash_function, v, masks, length, calc=calc)
+
     def push(self, feature, calc=True):
+        if self.v is None:
+            raise ValueError('push needs the accumulator, not kept by compact or int built Simhash')
         self.value, self.v = self._push(feature, self.hash_function, self.v, self.masks, self.length, calc=calc)
 
 
     def distance(self, another):
-        assert self.length == another.length
-        x = (self.value ^ another.value) & ((1 << self.length) - 1)
-        ans = 0
-        while x:
-            ans += 1
-            x &= x - 1
+        """
+        Hamming distance to `another`: a Simhash of the same length, a fingerprint (int) or its words
+        """
+        if isinstance(another, Simhash):
+            assert self.length == another.length
+            another = another.value
+        elif isinstance(another, np.ndarray):
+            another = words_value(another)
+        elif isinstance(another, np.integer):
+            another = int(another)
+        return bit_count((self.value ^ another) & ((1 << self.length) - 1))
+
+
+class SimhashBucket(object):
+    """
+    Entries of one SimhashIndex bucket as parallel arrays:
+    `values` holds the fingerprints as `words` uint64 words each, `ids` the obj_id.
+    Buckets of more than POSITIONS_SIZE entries keep `positions`, obj_id -> position
+    of its entry (-1 for an obj_id with several fingerprints in the bucket), smaller
+    buckets search `ids`.
+    """
+
+    __slots__ = ('words', 'values', 'ids', 'positions')
+
+    POSITIONS_SIZE = 16
+
+    def __init__(self, words):
+        self.words = words
+        self.values = array('Q')
+        self.ids = []
+        self.positions = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _row(self, i):
+        return self.values[i * self.words:(i + 1) * self.words].tolist()
+
+    def _scan(self, words, obj_id):
+        i = -1
+        while True:
+            try:
+                i = self.ids.index(obj_id, i + 1)
+            except ValueError:
+                return None
+            if self._row(i) == words:
+                return i
+
+    def _find(self, words, obj_id):
+        words = [int(x) for x in words]
+        if self.positions is not None:
+            i = self.positions.get(obj_id)
+            if i is None:
+                return None
+            if i >= 0:
+                return i if self._row(i) == words else None
+        return self._scan(words, obj_id)
+
+    def _track(self, start):
+        """
+        adds the entries start.. to `positions`, built once the bucket is big enough
+        """
+        if self.positions is None:
+            if len(self.ids) <= self.POSITIONS_SIZE:
+                return
+            self.positions, start = {}, 0
+        positions = self.positions
+        for i in range(start, len(self.ids)):
+            obj_id = self.ids[i]
+            positions[obj_id] = -1 if obj_id in positions else i
+
+    def _append(self, values, ids):
+        """
+        appends the entries `ids` with their fingerprints `values` (flat list of words)
+        """
+        start = len(self.ids)
+        self.values.extend(values)
+        self.ids.extend(intern(x) if isinstance(x, str) else x for x in ids)
+        self._track(start)
+
+    def add(self, words, obj_id):
+        words = [int(x) for x in words]
+        if self._find(words, obj_id) is None:
+            self._append(words, [obj_id])
+
+    def extend(self, values, ids):
+        """
+        adds the fingerprints `values` (uint64 array of shape (n, words)) with their `ids`,
+        entries already in the bucket are skipped as by `add`
+        """
+        rows = np.ascontiguousarray(values, dtype=np.uint64).reshape(-1, self.words).tolist()
+        new_values, new_ids, seen = [], [], set()
+        for row, obj_id in zip(rows, ids):
+            key = (tuple(row), obj_id)
+            if key not in seen and self._find(row, obj_id) is None:
+                seen.add(key)
+                new_values.extend(row)
+                new_ids.append(obj_id)
+
+        if new_ids:
+            self._append(new_values, new_ids)
+
+    def copy(self):
+        """
+        snapshot of the bucket, unaffected by later updates
+        """
+        ans = SimhashBucket(self.words)
+        ans.values = array('Q', self.values)
+        ans.ids = list(self.ids)
+        ans.positions = None if self.positions is None else dict(self.positions)
         return ans
 
+    def remove(self, words, obj_id):
+        i = self._find(words, obj_id)
+        if i is None:
+            return
+        last = len(self.ids) - 1
+        moved = self.ids[last]
+        self._swap_remove(i, last)
+
+        positions = self.positions
+        if positions is not None:
+            if positions[obj_id] >= 0 or obj_id not in self.ids:
+                del positions[obj_id]
+            if i != last and positions.get(moved) == last:
+                positions[moved] = i
+
+    def _swap_remove(self, i, last):
+        """
+        removes the entry i, replaced by the `last` one
+        """
+        w = self.words
+        if i != last:
+            self.values[i * w:(i + 1) * w] = self.values[-w:]
+            self.ids[i] = self.ids[last]
+        del self.values[-w:]
+        self.ids.pop()
+
+    def fingerprints(self):
+        """
+        fingerprints of the bucket, uint64 array of shape (len(self), words)
+        """
+        return np.frombuffer(self.values, dtype=np.uint64).reshape(-1, self.words)
+
+    def near(self, words, k, indices=False):
+        """
+        obj_id (or positions if `indices`) of the fingerprints within distance `k` of `words`
+        """
+        found = hamming_search(words, self.fingerprints(), k)[0]
+        if indices:
+            return found.tolist()
+        return [self.ids[i] for i in found]
+
 
 class SimhashIndex(object):
 
-    def __init__(self, objs, length=64, k=2, log=None):
+    def __init__(self, objs, length=64, k=2, log=None, blocks=None, key_blocks=1, metrics=None, big_bucket=200):
         """
-        `objs` is a list of (obj_id, simhash)
+        `objs` is a list or an iterator of (obj_id, simhash)
             obj_id is a string, simhash is an instance of Simhash
+            (see `add_many` to load texts or features by chunks)
         `length` is the same with the one for Simhash
         `k` is the tolerance
+        `blocks` is the number of blocks the fingerprint is split into (k + 1 by default)
+        `key_blocks` is the number of blocks forming the key of a table, at most blocks - k
+        `metrics` receives the measures of every query (see `utlilits.IndexMetrics`)
+        `big_bucket` is the bucket size from which a warning is logged by the queries
+
+        The index follows Manku et al. <http://www.wwwconference.org/www2007/papers/paper215.pdf>:
+        there is one table for every choice of `key_blocks` blocks out of `blocks`
+        (the permutation moving these blocks first), keyed by the bits of those blocks.
+        Fingerprints within distance k differ in at most k blocks, so they share
+        the key of at least one table. More blocks and key blocks make longer keys
+        and fewer candidates per query at the cost of more tables.
+
+        `bucket` maps the (table_index, key_value) keys to SimhashBucket
         """
         self.k = k
         self.length = length
-        count = len(objs)
+        self.words = (length + 63) // 64
+        self.metrics = metrics
+        self.big_bucket = big_bucket
+
+        self.blocks = k + 1 if blocks is None else blocks
+        self.key_blocks = key_blocks
+        if not 0 < self.blocks <= length:
+            raise ValueError('blocks must be in 1..%d, got %d' % (length, self.blocks))
+        if not 0 < key_blocks <= self.blocks - k:
+            raise ValueError('key_blocks must be in 1..blocks - k = %d, got %d' % (self.blocks - k, key_blocks))
+
+        self.tables = list(itertools.combinations(range(self.blocks), key_blocks))
+        offsets = self.offsets + [length]
+        self._block_masks = [(offsets[i], offsets[i + 1] - offsets[i]) for i in range(self.blocks)]
+        count = len(objs) if hasattr(objs, '__len__') else None
 
         if log is None:
             self.log = logging.getLogger("simhash")
         else:
             self.log = log
 
-        self.log.info('Initializing %s data.', count)
+        self.log.info('Initializing %s data.', count if count is not None else 'streamed')
 
-        self.bucket = collections.defaultdict(set)
+        self.bucket = {}
 
         for i, q in enumerate(objs):
-            if i % 10000 == 0 or i == count - 1:
-                self.log.info('%s/%s', i + 1, count)
+            if i % 10000 == 0 or (count is not None and i == count - 1):
+                self.log.info('%s/%s', i + 1, count if count is not None else '?')
 
             self.add(*q)
 
@@ -132,21 +378,27 @@ class SimhashIndex(object):
         """
         assert simhash.length == self.length
 
+        start = time.perf_counter() if self.metrics is not None else 0.
         ans = set()
-
-        for key in self.get_keys(simhash):
-            dups = self.bucket[key]
+        words = fingerprint_words(simhash.value, self.length)
+        keys = list(self.get_keys(simhash))
+
+        key_seconds = time.perf_counter() - start if self.metrics is not None else 0.
+        sizes = []
+        for key in keys:
+            dups = self._get_bucket(key)
+            if dups is None:
+                continue
             self.log.debug('key:%s', key)
-            if len(dups) > 200:
+            sizes.append(len(dups))
+            if len(dups) > self.big_bucket:
                 self.log.warning('Big bucket found. key:%s, len:%s', key, len(dups))
 
-            for dup in dups:
-                sim2, obj_id = dup.split(',', 1)
-                sim2 = Simhash(long(sim2, 16), self.length)
+            ans.update(dups.near(words, self.k))
 
-                d = simhash.distance(sim2)
-                if d <= self.k:
-                    ans.add(obj_id)
+        if self.metrics is not None:
+            self.metrics.record_query(sum(sizes), len(ans), key_seconds,
+                                      time.perf_counter() - start - key_seconds, sizes)
         return list(ans)
 
     def add(self, obj_id, simhash):
@@ -156,9 +408,76 @@ class SimhashIndex(object):
         """
         assert simhash.length == self.length
 
-        for key in self.get_keys(simhash):
-            v = '%x,%s' % (simhash.value, obj_id)
-            self.bucket[key].add(v)
+        self._add_value(obj_id, simhash.value)
+
+    def _add_value(self, obj_id, value):
+        words = fingerprint_words(value, self.length)
+        for key in self.get_keys(value):
+            self._add_to_bucket(key, [words], [obj_id])
+
+    def _get_bucket(self, key):
+        """
+        bucket of `key` searched by the queries (None if there is none), nothing is inserted
+        """
+        return self.bucket.get(key)
+
+    def _add_to_bucket(self, key, values, ids):
+        dups = self.bucket.get(key)
+        if dups is None:
+            dups = self.bucket[key] = SimhashBucket(self.words)
+        if len(ids) == 1:
+            dups.add(list(values[0]), ids[0])
+        else:
+            dups.extend(values, ids)
+
+    def _remove_from_bucket(self, key, words, obj_id):
+        dups = self.bucket.get(key)
+        if dups is not None:
+            dups.remove(words, obj_id)
+            if not dups:
+                del self.bucket[key]
+
+    def add_many(self, objs, chunksize=1024, **kwargs):
+        """
+        Bulk load of an iterable (list, iterator or generator) of (obj_id, value)
+            value is a Simhash, a fingerprint (int or array of words), a text or features
+
+        The items are read `chunksize` at a time: the texts and features of a chunk
+        are signed together (`kwargs` are the Simhash arguments: reg, hash_function, ...)
+        and inserted by table with one bucket update per key, so memory does not
+        grow with the length of `objs`.
+        return the number of items loaded
+        """
+        count = 0
+        for chunk in iter_chunks(objs, chunksize):
+            ids = [x[0] for x in chunk]
+            values = [x[1].value if isinstance(x[1], Simhash) else x[1] for x in chunk]
+            values = [int(x) if isinstance(x, np.integer) else x for x in values]
+
+            docs = [n for n, x in enumerate(values) if not isinstance(x, (int, long, np.ndarray))]
+            if docs:
+                signed = Simhash.build_many([values[n] for n in docs], length=self.length, **kwargs)
+                for n, value in zip(docs, signed):
+                    values[n] = int(value) if self.length <= 64 else value
+
+            self._add_values(ids, values)
+            count += len(chunk)
+            self.log.info('%s loaded', count)
+
+        return count
+
+    def _add_values(self, ids, values):
+        if self.wide_keys:
+            for obj_id, value in zip(ids, values):
+                self._add_value(obj_id, words_value(value) if isinstance(value, np.ndarray) else value)
+            return
+
+        values = fingerprint_matrix(values, self.length)
+        for i, keys in enumerate(self.get_keys_many(values)):
+            order = np.argsort(keys, kind='stable')
+            uniques, starts = np.unique(keys[order], return_index=True)
+            for key, group in zip(uniques.tolist(), np.split(order, starts[1:])):
+                self._add_to_bucket((i, key), values[group], [ids[n] for n in group])
 
     def delete(self, obj_id, simhash):
         """
@@ -167,49 +486,365 @@ class SimhashIndex(object):
         """
         assert simhash.length == self.length
 
+        words = fingerprint_words(simhash.value, self.length)
         for key in self.get_keys(simhash):
-            v = '%x,%s' % (simhash.value, obj_id)
-            if v in self.bucket[key]:
-                self.bucket[key].remove(v)
+            self._remove_from_bucket(key, words, obj_id)
 
     @property
     def offsets(self):
         """
-        You may optimize this method according to <http://www.wwwconference.org/www2007/papers/paper215.pdf>
+        bit offsets of the blocks
         """
-        return [self.length // (self.k + 1) * i for i in range(self.k + 1)]
+        return [self.length // self.blocks * i for i in range(self.blocks)]
 
     def get_keys(self, simhash):
-        for i, offset in enumerate(self.offsets):
-            if i == (len(self.offsets) - 1):
-                m = 2 ** (self.length - offset) - 1
-            else:
-                m = 2 ** (self.offsets[i + 1] - offset) - 1
-            c = simhash.value >> offset & m
-            yield '%x:%x' % (c, i)
+        value = getattr(simhash, 'value', simhash)
+        if isinstance(value, np.ndarray):
+            value = words_value(value)
+        for i, table in enumerate(self.tables):
+            c = 0
+            for block in table:
+                offset, width = self._block_masks[block]
+                c = c << width | (value >> offset & ((1 << width) - 1))
+            yield i, c
+
+    def get_keys_many(self, values):
+        """
+        keys of the fingerprints `values` (uint64 array of shape (n,) or (n, words)):
+        a list with an uint64 array of the key values for every table,
+        the keys must be at most 64 bits long (see `wide_keys`)
+        """
+        if self.wide_keys:
+            raise ValueError('keys of more than 64 bits, use more blocks')
+        values = np.asarray(values, dtype=np.uint64).reshape(-1, self.words)
+        ans = []
+        for table in self.tables:
+            c = None
+            for block in table:
+                part = block_bits(values, *self._block_masks[block])
+                c = part if c is None else (c << np.uint64(self._block_masks[block][1])) | part
+            ans.append(c)
+        return ans
+
+    @property
+    def wide_keys(self):
+        """
+        True when the key of a table has more than 64 bits
+        """
+        return any(sum(self._block_masks[block][1] for block in table) > 64 for table in self.tables)
+
+    def expected_candidates(self, count=None):
+        """
+        Expected number of candidates checked by a query against `count` random
+        fingerprints (the number of indexed entries by default)
+        """
+        if count is None:
+            count = sum(len(dups) for key, dups in self.bucket.items() if key[0] == 0)
+
+        return sum(count / 2. ** sum(self._block_masks[block][1] for block in table) for table in self.tables)
 
     def bucket_size(self):
         return len(self.bucket)
 
+    def bucket_sizes(self):
+        """
+        number of entries of every bucket
+        """
+        return [len(dups) for dups in list(self.bucket.values())]
+
+    def stats(self):
+        """
+        bucket size distribution of the index (see `utlilits.bucket_stats`), overall and
+        for every table under 'tables'
+        """
+        tables = [[] for _ in self.tables]
+        for (i, _), dups in list(self.bucket.items()):
+            tables[i].append(len(dups))
+        ans = bucket_stats(self.bucket_sizes())
+        ans['tables'] = [bucket_stats(x) for x in tables]
+        return ans
+
+    def entries(self):
+        """
+        (ids, fingerprints) of the indexed entries, fingerprints as an uint64 array of shape (n, words)
+        """
+        ids, fingerprints = [], [np.empty((0, self.words), dtype=np.uint64)]
+        for key in list(self.bucket):
+            if key[0] == 0:
+                dups = self._get_bucket(key)
+                if dups is not None:
+                    rows = dups.fingerprints()
+                    ids.extend(dups.ids[:len(rows)])
+                    fingerprints.append(rows)
+        return ids, np.concatenate(fingerprints)
+
+    def save(self, path, hash_function=None):
+        """
+        Saves the index to `path` (see `utlilits.write_store`): the entries once, and for
+        every table its sorted keys with the matching entry numbers;
+        `hash_function` of the fingerprints is recorded in the header
+        """
+        if self.wide_keys:
+            raise ValueError('keys of more than 64 bits can not be saved, use more blocks')
+
+        ids, fingerprints = self.entries()
+        keys = self.get_keys_many(fingerprints)
+
+        arrays = pack_ids(ids)
+        arrays['fingerprints'] = fingerprints
+        orders = [np.argsort(x, kind='stable') for x in keys]
+        arrays['table_keys'] = np.array([x[order] for x, order in zip(keys, orders)],
+                                        dtype=np.uint64).reshape(len(self.tables), len(ids))
+        arrays['table_entries'] = np.array(orders, dtype=np.int64).reshape(len(self.tables), len(ids))
+
+        write_store(path, {'kind': 'simhash_index', 'length': self.length, 'k': self.k, 'blocks': self.blocks,
+                           'key_blocks': self.key_blocks, 'hash_function': hash_function_name(hash_function)},
+                    arrays)
+
+    @staticmethod
+    def load(path, mmap=True, log=None, metrics=None, big_bucket=200):
+        """
+        Opens an index saved by `save`, memory mapped unless `mmap` is False
+        return a read-only MappedSimhashIndex
+        """
+        return MappedSimhashIndex(path, mmap=mmap, log=log, metrics=metrics, big_bucket=big_bucket)
+
+
+class AppendOnlySimhashBucket(SimhashBucket):
+    """
+    SimhashBucket read without lock while a writer adds entries: `values` is an uint64
+    array of shape (capacity, words) grown by doubling, and `size` is updated after the
+    entries are written, so readers search the first `size` entries, which never change.
+    Entries are removed from a copy of the bucket (see ConcurrentSimhashIndex).
+    """
+
+    __slots__ = ('size',)
+
+    def __init__(self, words):
+        SimhashBucket.__init__(self, words)
+        self.values = np.empty((0, words), dtype=np.uint64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _row(self, i):
+        return self.values[i].tolist()
+
+    def _append(self, values, ids):
+        start = self.size
+        end = start + len(ids)
+        if end > len(self.values):
+            grown = np.empty((max(end, 2 * len(self.values)), self.words), dtype=np.uint64)
+            grown[:start] = self.values[:start]
+            self.values = grown
+        self.values[start:end] = np.array(values, dtype=np.uint64).reshape(-1, self.words)
+        self.ids.extend(intern(x) if isinstance(x, str) else x for x in ids)
+        self.size = end
+        self._track(start)
+
+    def _swap_remove(self, i, last):
+        self.values[i] = self.values[last]
+        self.ids[i] = self.ids[last]
+        self.ids.pop()
+        self.size = last
+
+    def copy(self):
+        ans = AppendOnlySimhashBucket(self.words)
+        ans.values = self.values[:self.size].copy()
+        ans.ids = self.ids[:self.size]
+        ans.size = len(ans.ids)
+        ans.positions = None if self.positions is None else dict(self.positions)
+        return ans
+
+    def fingerprints(self):
+        return self.values[:self.size]
+
+    def near(self, words, k, indices=False):
+        size = self.size
+        values, ids = self.values, self.ids
+        found = hamming_search(words, values[:size], k)[0]
+        if indices:
+            return found.tolist()
+        return [ids[i] for i in found]
+
+
+class ConcurrentSimhashIndex(SimhashIndex):
+    """
+    SimhashIndex safe for concurrent add / delete / get_near_dups from many threads.
+
+    The buckets are partitioned over `stripes` locks by key: writers lock the
+    stripe of each bucket they update, so writers of different buckets proceed in
+    parallel. Queries search the buckets without lock nor copy and never insert into
+    `bucket`: the buckets are AppendOnlySimhashBucket, and a delete updates a copy of
+    its bucket and swaps it into `bucket`.
+    """
+
+    def __init__(self, objs, length=64, k=2, log=None, blocks=None, key_blocks=1, metrics=None, big_bucket=200,
+                 stripes=64):
+        self.stripes = [threading.Lock() for _ in range(stripes)]
+        SimhashIndex.__init__(self, objs, length=length, k=k, log=log, blocks=blocks, key_blocks=key_blocks,
+                              metrics=metrics, big_bucket=big_bucket)
+
+    def _stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def _add_to_bucket(self, key, values, ids):
+        with self._stripe(key):
+            dups = self.bucket.get(key)
+            if dups is None:
+                dups = AppendOnlySimhashBucket(self.words)
+                dups.extend(values, ids)
+                self.bucket[key] = dups
+            else:
+                dups.extend(values, ids)
+
+    def _remove_from_bucket(self, key, words, obj_id):
+        with self._stripe(key):
+            dups = self.bucket.get(key)
+            if dups is None or dups._find(words, obj_id) is None:
+                return
+            dups = dups.copy()
+            dups.remove(words, obj_id)
+            if dups:
+                self.bucket[key] = dups
+            else:
+                del self.bucket[key]
+
+
+class MappedSimhashIndex(SimhashIndex):
+    """
+    Read-only SimhashIndex over a store written by `SimhashIndex.save`: the keys of
+    a table are searched with np.searchsorted, nothing is rebuilt at load time
+    """
+
+    def __init__(self, path, mmap=True, log=None, metrics=None, big_bucket=200):
+        header, arrays = read_store(path, mmap=mmap)
+        if header.get('kind') != 'simhash_index':
+            raise ValueError('{0} is not a SimhashIndex store, kind {1!r}'.format(path, header.get('kind')))
+
+        SimhashIndex.__init__(self, [], length=header['length'], k=header['k'], log=log,
+                              blocks=header['blocks'], key_blocks=header['key_blocks'],
+                              metrics=metrics, big_bucket=big_bucket)
+        self.hash_function = header['hash_function']
+        self.ids = StoredIds(arrays)
+        self.fingerprints = arrays['fingerprints']
+        self.table_keys = arrays['table_keys']
+        self.table_entries = arrays['table_entries']
+
+    def get_near_dups(self, simhash):
+        """
+        `simhash` is an instance of Simhash
+        return a list of obj_id
+        """
+        assert simhash.length == self.length
+
+        start = time.perf_counter() if self.metrics is not None else 0.
+        entries, sizes = [], []
+        for i, key in self.get_keys(simhash):
+            keys = self.table_keys[i]
+            lo = np.searchsorted(keys, np.uint64(key), side='left')
+            hi = np.searchsorted(keys, np.uint64(key), side='right')
+            if hi > lo:
+                sizes.append(int(hi - lo))
+            if hi - lo > self.big_bucket:
+                self.log.warning('Big bucket found. key:%s, len:%s', (i, key), hi - lo)
+            entries.append(self.table_entries[i, lo:hi])
+
+        key_seconds = time.perf_counter() - start if self.metrics is not None else 0.
+        entries = np.unique(np.concatenate(entries))
+        found = hamming_search(fingerprint_words(simhash.value, self.length), self.fingerprints[entries], self.k)[0]
+        ans = list(set(self.ids[int(x)] for x in entries[found]))
+
+        if self.metrics is not None:
+            self.metrics.record_query(sum(sizes), len(ans), key_seconds,
+                                      time.perf_counter() - start - key_seconds, sizes)
+        return ans
+
+    def add(self, obj_id, simhash):
+        raise TypeError('MappedSimhashIndex is read-only, use to_index() to modify it')
+
+    def add_many(self, objs, chunksize=1024, **kwargs):
+        raise TypeError('MappedSimhashIndex is read-only, use to_index() to modify it')
+
+    def delete(self, obj_id, simhash):
+        raise TypeError('MappedSimhashIndex is read-only, use to_index() to modify it')
+
+    def _add_to_bucket(self, key, values, ids):
+        raise TypeError('MappedSimhashIndex is read-only, use to_index() to modify it')
+
+    def _remove_from_bucket(self, key, words, obj_id):
+        raise TypeError('MappedSimhashIndex is read-only, use to_index() to modify it')
+
+    def entries(self):
+        return list(self.ids), np.asarray(self.fingerprints)
+
+    def bucket_size(self):
+        return sum(len(np.unique(keys)) for keys in self.table_keys)
+
+    def bucket_sizes(self):
+        return sum((np.unique(keys, return_counts=True)[1].tolist() for keys in self.table_keys), [])
+
+    def stats(self):
+        ans = bucket_stats(self.bucket_sizes())
+        ans['tables'] = [bucket_stats(np.unique(keys, return_counts=True)[1]) for keys in self.table_keys]
+        return ans
+
+    def expected_candidates(self, count=None):
+        if count is None:
+            count = len(self.ids)
+        return SimhashIndex.expected_candidates(self, count)
+
+    def to_index(self):
+        """
+        mutable SimhashIndex with the same entries
+        """
+        index = SimhashIndex([], length=self.length, k=self.k, log=self.log,
+                             blocks=self.blocks, key_blocks=self.key_blocks)
+        values = [sum(x << (64 * w) for w, x in enumerate(row)) for row in self.fingerprints.tolist()]
+        index.add_many(zip(self.ids, values))
+        return index
+
 
 class Superminhash(object):
 
+    __slots__ = ('length', 'values', 'q', 'p', 'b', 'i', 'a', 'hash_function', 'log', 'weighted', 'cache')
+
     def __init__(self, value, length=64,
                  reg=r'[\w\u4e00-\u9fcc]+', tokenize_slide_width=4, slide_words_delimiter='',
-                 hash_function=None, log=None):
+                 hash_function=None, log=None, weighted=None, cache=None):
+
+        """
+        `length` is the number of signature values
+
+        The state is kept in contiguous typed arrays: `values` float64, `q` int64,
+        `p` uint16 and `b` int64; copying a Superminhash copies these arrays.
+
+        Signatures are built by a batched engine: every feature is hashed to 64 bits
+        and expanded by a splitmix64 counter sequence into a permutation of the slots
+        and `length` uniforms (see `utlilits.superminhash_sequence`), so the values
+        depend only on the features and `hash_function`, not on any global RNG state.
+
+        `weighted` signatures estimate the weighted Jaccard similarity of the features:
+        the weights of (token, weight) tuples and dicts (the counts of the shingles of
+        a text) are used through consistent weighted sampling (see
+        `utlilits.weighted_superminhash_candidates`) instead of being dropped.
+        A copy of a Superminhash is weighted like it by default.
+
+        `cache` is an optional LRUCache (shareable between instances) of the
+        candidate values and permutation of the features by hash (unweighted signatures),
+        a copy of a Superminhash uses its cache.
+        """
 
         self.length = length
-        self.values = [MAX_UINT32] * length  # float64
-        self.q = [-1] * length  # int64
-        self.p = list(range(length))  # uint16
-        self.b = [0] * (length - 1) + [np.int64(length)]  # int64
-        self.i = 0  # int64
-        self.a = length - 1  # uint16
+        if weighted is None:
+            weighted = value.weighted if isinstance(value, Superminhash) else False
+        self.weighted = weighted
+        if cache is None and isinstance(value, Superminhash):
+            cache = value.cache
+        self.cache = cache
 
-        if hash_function is None:
-            self.hash_function = _hash_function
-        else:
-            self.hash_function = hash_function
+        self.hash_function = get_hash_function(hash_function)
 
         if log is None:
             self.log = logging.getLogger(type(self).__name__.lower())
@@ -221,40 +856,80 @@ class Superminhash(object):
                                                                   'tokenize_slide_width': tokenize_slide_width,
                                                                   'slide_words_delimiter': slide_words_delimiter},
                                                    kwargs={'hash_function': self.hash_function,
-                                                           'push_function': self._push, 'length': self.length})
+                                                           'push_function': self._push_many, 'length': self.length,
+                                                           'weighted': self.weighted})
 
-    def _push(self, feature, values, q, p, b, i, a, hash_function=None):
+    @classmethod
+    def build_many(cls, docs, length=64,
+                   reg=r'[\w\u4e00-\u9fcc]+', tokenize_slide_width=4, slide_words_delimiter='',
+                   hash_function=None, weighted=False, cache=None, doc_cache=None, shingle_ids=False):
+        """
+        `docs` is an iterable of texts or features (anything accepted as `value`)
+        return float64 array of shape (n_docs, length), row n is the `values` of docs[n]
+        (built `weighted` or not)
+
+        `cache` is an optional LRUCache of the candidates of the features,
+        `doc_cache` an optional LRUCache of the signatures of the texts by digest
+        `shingle_ids` hashes the shingles of the texts by `utlilits.shingle_hashes`
+        without building the shingle strings (nor calling `hash_function`); these
+        signatures are only comparable with signatures built the same way
+
+        No Superminhash objects are created, the features of all the documents
+        are hashed and expanded by the batched engine together.
+        """
+        hash_function = get_hash_function(hash_function)
+
+        tokenize_args = {'reg': reg, 'tokenize_slide_width': tokenize_slide_width,
+                         'slide_words_delimiter': slide_words_delimiter}
+
+        if doc_cache is not None:
+            key_args = ('superminhash', length, _cache_key(hash_function), getattr(reg, 'pattern', reg),
+                        tokenize_slide_width, slide_words_delimiter, weighted, shingle_ids)
+            return cached_signatures(docs, doc_cache, key_args,
+                                     lambda x: cls.build_many(x, length, reg, tokenize_slide_width,
+                                                              slide_words_delimiter, hash_function, weighted, cache,
+                                                              shingle_ids=shingle_ids),
+                                     (length,), np.float64)
+
+        hashes, weights = [], []
+        for doc in docs:
+            if shingle_ids and isinstance(doc, basestring):
+                ids, w = shingle_hashes(doc, **tokenize_args)
+                hashes.append(ids)
+            elif not weighted:
+                hashes.append(superminhash_hash_features(superminhash_features(get_features(doc, tokenize_args)),
+                                                         hash_function))
+                continue
+            else:
+                tokens, w = superminhash_weighted_features(get_features(doc, tokenize_args))
+                hashes.append(superminhash_hash_features(tokens, hash_function))
+            weights.append(w)
+        weights = (np.concatenate(weights).astype(np.float64) if weights else np.empty(0)) if weighted else None
+
+        counts = [len(x) for x in hashes]
+        hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
 
-        np.random.seed(seed=(hash(feature) if hash_function is None else hash_function(feature)) % MAX_UINT32)
+        return superminhash_signature_matrix(hashes, counts, length, weights=weights,
+                                             cache=None if weighted else cache)
 
-        for j in range(a):
-            r = np.float64(np.random.randint(MAX_UINT32)) / MAX_UINT32
-            offset = np.random.randint(MAX_UINT32) % np.uint32(np.uint16(len(values)) - j)
-            k = np.uint32(j) + offset
+    def _push_many(self, features, values, q, p, b, i, a, hash_function=None):
 
-            if q[j] != i:
-                q[j] = i
-                p[j] = np.uint16(j)
+        if hash_function is None:
+            hash_function = hash
 
-            if q[k] != i:
-                q[k] = i
-                p[k] = np.uint16(k)
+        if self.weighted:
+            tokens, weights = superminhash_weighted_features(features)
+            hashes = superminhash_hash_features(tokens, hash_function)
+            values, q, i = weighted_superminhash_push_hashes(hashes, weights, values, q, i)
+            return values, q, p, b, i, a
 
-            p[j], p[k] = p[k], p[j]
-            rj = r + np.float64(j)
-            if rj < values[p[j]]:
+        hashes = superminhash_hash_features(features, hash_function)
 
-                jc = np.uint16(min(values[p[j]], np.float64(len(values) - 1)))
-                values[p[j]] = rj
-                if j < jc:
-                    b[jc] -= 1
-                    b[j] += 1
-                    while b[a] == 0:
-                        a -= 1
+        return superminhash_push_hashes(hashes, values, q, p, b, i, a, cache=self.cache)
 
-        i += 1
+    def _push(self, feature, values, q, p, b, i, a, hash_function=None):
 
-        return values, q, p, b, i, a
+        return self._push_many([feature], values, q, p, b, i, a, hash_function)
 
     # // Push ...
     def push(self, feature):
@@ -266,17 +941,463 @@ class Superminhash(object):
     def similarity(self, other):
 
         if self.length != other.length:
-            raise ValueError("signatures not of same length, sign has length %d, while other has length %d" \
-                             , len(self.values), len(other.values))
+            raise ValueError("signatures not of same length, sign has length %d, while other has length %d"
+                             % (len(self.values), len(other.values)))
 
-        sim = 0.0
-        for i, element in enumerate(self.values):
-            if element == other.values[i]:
-                sim += 1
-
-        return sim / np.float64(self.length)
+        return np.count_nonzero(self.values == other.values) / np.float64(self.length)
 
     # // Distance ...
     def distance(self, other):
 
-        return 1 - self.similarity(other)
\ No newline at end of file
+        return 1 - self.similarity(other)
+
+    # // Cardinality ...
+    def _check_unweighted(self, *others):
+        if self.weighted or any(x.weighted for x in others):
+            raise ValueError('cardinality estimations need unweighted signatures')
+
+    def cardinality(self):
+        """
+        Estimated number of distinct features, at most the number `i` of pushed features
+        """
+        self._check_unweighted()
+        return min(superminhash_cardinality(self.values), float(self.i))
+
+    def union_cardinality(self, other):
+
+        self._check_unweighted(other)
+        return min(superminhash_union_cardinality(self.values, other.values), float(self.i + other.i))
+
+    def intersection_cardinality(self, other):
+
+        self._check_unweighted(other)
+        return min(superminhash_intersection_cardinality(self.values, other.values), float(min(self.i, other.i)))
+
+    def containment(self, other):
+        """
+        Estimated fraction of the features of this signature contained in `other`
+        """
+        if self.length != other.length:
+            raise ValueError("signatures not of same length, sign has length %d, while other has length %d"
+                             % (len(self.values), len(other.values)))
+        self._check_unweighted(other)
+
+        return superminhash_containment(self.values, other.values)
+
+    # // Merge ...
+    def update(self, other):
+        """
+        Adds the features of the Superminhash `other` (same length and hash function)
+        to this one in place, as if they had been pushed after its own features
+        """
+        if not same_hash_function(self.hash_function, other.hash_function):
+            raise ValueError('signatures built with different hash functions')
+        if self.weighted != other.weighted:
+            raise ValueError('weighted and unweighted signatures can not be merged')
+
+        self.values, self.q, self.p, self.b, self.i, self.a = superminhash_merge_states(
+            (self.values, self.q, self.p, self.b, self.i, self.a),
+            (other.values, other.q, other.p, other.b, other.i, other.a), weighted=self.weighted)
+        return self
+
+    def merge(self, other):
+        """
+        Superminhash of the union of the features of this one and `other`
+        """
+        return Superminhash(self, length=self.length, hash_function=self.hash_function, log=self.log).update(other)
+
+    __or__ = merge
+    __ior__ = update
+
+    @classmethod
+    def union_many(cls, signatures):
+        """
+        Superminhash of the union of the features of an iterable of Superminhash
+        (for instance the signatures of the shards of a document)
+        """
+        signatures = iter(signatures)
+        try:
+            ans = next(signatures)
+        except StopIteration:
+            raise ValueError('union_many of no signatures')
+
+        ans = cls(ans, length=ans.length, hash_function=ans.hash_function, log=ans.log)
+        for other in signatures:
+            ans.update(other)
+        return ans
+
+
+class SuperminhashLSHIndex(object):
+
+    def __init__(self, objs, length=64, threshold=0.5, bands=None, rows=None, log=None):
+        """
+        `objs` is a list or an iterator of (obj_id, superminhash)
+            obj_id is a string, superminhash is an instance of Superminhash
+            (or its `values` array), see `add_many` to load texts or features by chunks
+        `length` is the same with the one for Superminhash
+        `threshold` is the default similarity threshold of `query`
+        `bands`, `rows` split the signature into `bands` bands of `rows` values,
+            chosen by `superminhash_lsh_params` for `threshold` when not given
+        """
+        self.length = length
+        self.threshold = threshold
+
+        if bands is None or rows is None:
+            bands, rows = superminhash_lsh_params(threshold, length)
+        if bands * rows > length:
+            raise ValueError('bands * rows must not exceed length, got %d * %d > %d' % (bands, rows, length))
+        self.bands = bands
+        self.rows = rows
+
+        if log is None:
+            self.log = logging.getLogger("superminhash")
+        else:
+            self.log = log
+
+        self.bucket = collections.defaultdict(set)
+        self.signatures = {}
+
+        count = len(objs) if hasattr(objs, '__len__') else None
+        self.log.info('Initializing %s data.', count if count is not None else 'streamed')
+
+        for i, q in enumerate(objs):
+            if i % 10000 == 0 or (count is not None and i == count - 1):
+                self.log.info('%s/%s', i + 1, count if count is not None else '?')
+
+            self.add(*q)
+
+    def _values(self, superminhash):
+        values = np.asarray(getattr(superminhash, 'values', superminhash), dtype=np.float64)
+        assert len(values) == self.length
+        return values
+
+    def get_keys(self, superminhash):
+        keys = band_hashes(self._values(superminhash), self.bands, self.rows)[0]
+        return [(x, int(key)) for x, key in enumerate(keys)]
+
+    def add(self, obj_id, superminhash):
+        """
+        `obj_id` is a string
+        `superminhash` is an instance of Superminhash
+        """
+        values = self._values(superminhash)
+        if obj_id in self.signatures:
+            self.delete(obj_id, self.signatures[obj_id])
+
+        self.signatures[obj_id] = values.copy()
+        for key in self.get_keys(values):
+            self.bucket[key].add(obj_id)
+
+    def add_many(self, objs, chunksize=1024, **kwargs):
+        """
+        Bulk load of an iterable (list, iterator or generator) of (obj_id, text_or_features),
+        signed `chunksize` at a time by `Superminhash.build_many` (`kwargs` are its arguments)
+        with the band keys of a chunk computed together
+        return the number of items loaded
+        """
+        count = 0
+        for ids, matrix in sign_stream(objs, 'superminhash', chunksize, length=self.length, **kwargs):
+            keys = band_hashes(matrix, self.bands, self.rows).tolist()
+            for obj_id, values, row in zip(ids, matrix, keys):
+                if obj_id in self.signatures:
+                    self.delete(obj_id, self.signatures[obj_id])
+                self.signatures[obj_id] = values.copy()
+                for x, key in enumerate(row):
+                    self.bucket[(x, key)].add(obj_id)
+
+            count += len(ids)
+            self.log.info('%s loaded', count)
+
+        return count
+
+    def delete(self, obj_id, superminhash):
+        """
+        `obj_id` is a string
+        `superminhash` is an instance of Superminhash, the stored signature of
+            `obj_id` is used instead when there is one
+        """
+        if obj_id in self.signatures:
+            superminhash = self.signatures[obj_id]
+        for key in self.get_keys(superminhash):
+            dups = self.bucket.get(key)
+            if dups is not None and obj_id in dups:
+                dups.remove(obj_id)
+                if not dups:
+                    del self.bucket[key]
+
+        self.signatures.pop(obj_id, None)
+
+    def query(self, superminhash, threshold=None):
+        """
+        `superminhash` is an instance of Superminhash
+        return a list of (obj_id, similarity) with similarity >= `threshold`,
+        sorted by decreasing similarity; candidates sharing a band are
+        re-ranked by their exact signature similarity
+        """
+        if threshold is None:
+            threshold = self.threshold
+        values = self._values(superminhash)
+
+        candidates = set()
+        for key in self.get_keys(values):
+            candidates.update(self.bucket.get(key, ()))
+        if not candidates:
+            return []
+
+        candidates = list(candidates)
+        sims = similarity_matrix(values, np.array([self.signatures[x] for x in candidates]))[0]
+        ans = [(candidates[i], float(sims[i])) for i in np.flatnonzero(sims >= threshold)]
+        return sorted(ans, key=lambda x: -x[1])
+
+    def bucket_size(self):
+        return len(self.bucket)
+
+    def entries(self):
+        """
+        (ids, matrix) of the indexed signatures, matrix of shape (n, length)
+        """
+        ids = list(self.signatures)
+        return ids, np.array([self.signatures[x] for x in ids], dtype=np.float64).reshape(-1, self.length)
+
+    def save(self, path, hash_function=None):
+        """
+        Saves the signatures with the banding parameters (see `save_signatures`) and,
+        for every band, its sorted keys with the matching entry numbers
+        """
+        ids, matrix = self.entries()
+        band_keys, band_entries = _band_tables(matrix, self.bands, self.rows)
+        save_signatures(path, ids, matrix, hash_function=hash_function,
+                        header={'kind': 'superminhash_lsh_index', 'threshold': self.threshold,
+                                'bands': self.bands, 'rows': self.rows},
+                        arrays={'band_keys': band_keys, 'band_entries': band_entries})
+
+    @classmethod
+    def load(cls, path, mmap=True, log=None, chunksize=None):
+        """
+        Opens an index saved by `save`, memory mapped unless `mmap` is False
+        return a read-only MappedSuperminhashLSHIndex
+        """
+        return MappedSuperminhashLSHIndex(path, mmap=mmap, log=log, chunksize=chunksize)
+
+
+def _band_tables(matrix, bands, rows, chunksize=None):
+    """
+    band keys of the signatures `matrix` sorted for every band: (keys, entries) uint64 and
+    int64 arrays of shape (bands, n), entries[x] are the row numbers of the sorted keys[x]
+    """
+    if chunksize is None:
+        chunksize = SIMILARITY_CHUNKSIZE
+    keys = np.empty((bands, len(matrix)), dtype=np.uint64)
+    for start in range(0, len(matrix), chunksize):
+        keys[:, start:start + chunksize] = band_hashes(matrix[start:start + chunksize], bands, rows).T
+
+    entries = np.argsort(keys, axis=1, kind='stable')
+    return np.take_along_axis(keys, entries, axis=1), entries.astype(np.int64)
+
+
+class MappedSuperminhashLSHIndex(SuperminhashLSHIndex):
+    """
+    Read-only SuperminhashLSHIndex over a store written by `SuperminhashLSHIndex.save`:
+    the keys of a band are searched with np.searchsorted, nothing is rebuilt at load time
+    """
+
+    def __init__(self, path, mmap=True, log=None, chunksize=None):
+        header, arrays = read_store(path, mmap=mmap)
+        if header.get('kind') != 'superminhash_lsh_index':
+            raise ValueError('{0} is not a SuperminhashLSHIndex store, kind {1!r}'.format(path, header.get('kind')))
+
+        SuperminhashLSHIndex.__init__(self, [], length=header['length'], threshold=header['threshold'],
+                                      bands=header['bands'], rows=header['rows'], log=log)
+        self.hash_function = header['hash_function']
+        self.ids = StoredIds(arrays)
+        self.matrix = arrays['signatures']
+        if 'band_keys' in arrays:
+            self.band_keys = arrays['band_keys']
+            self.band_entries = arrays['band_entries']
+        else:
+            self.band_keys, self.band_entries = _band_tables(self.matrix, self.bands, self.rows, chunksize)
+
+    def query(self, superminhash, threshold=None):
+        if threshold is None:
+            threshold = self.threshold
+        values = self._values(superminhash)
+
+        entries = [np.empty(0, dtype=np.int64)]
+        for x, key in self.get_keys(values):
+            keys = self.band_keys[x]
+            lo = np.searchsorted(keys, np.uint64(key), side='left')
+            hi = np.searchsorted(keys, np.uint64(key), side='right')
+            entries.append(self.band_entries[x, lo:hi])
+        entries = np.unique(np.concatenate(entries))
+        if not len(entries):
+            return []
+
+        sims = similarity_matrix(values, np.asarray(self.matrix[entries]))[0]
+        ans = [(self.ids[int(entries[i])], float(sims[i])) for i in np.flatnonzero(sims >= threshold)]
+        return sorted(ans, key=lambda x: -x[1])
+
+    def add(self, obj_id, superminhash):
+        raise TypeError('MappedSuperminhashLSHIndex is read-only, use to_index() to modify it')
+
+    def add_many(self, objs, chunksize=1024, **kwargs):
+        raise TypeError('MappedSuperminhashLSHIndex is read-only, use to_index() to modify it')
+
+    def delete(self, obj_id, superminhash):
+        raise TypeError('MappedSuperminhashLSHIndex is read-only, use to_index() to modify it')
+
+    def entries(self):
+        return list(self.ids), np.asarray(self.matrix)
+
+    def bucket_size(self):
+        return sum(len(np.unique(keys)) for keys in self.band_keys)
+
+    def to_index(self, chunksize=None):
+        """
+        mutable SuperminhashLSHIndex with the same entries, the signatures stay memory mapped
+        """
+        index = SuperminhashLSHIndex([], length=self.length, threshold=self.threshold,
+                                     bands=self.bands, rows=self.rows, log=self.log)
+        if chunksize is None:
+            chunksize = SIMILARITY_CHUNKSIZE
+
+        for start in range(0, len(self.ids), chunksize):
+            keys = band_hashes(self.matrix[start:start + chunksize], self.bands, self.rows).tolist()
+            for n, row in enumerate(keys, start):
+                obj_id = self.ids[n]
+                index.signatures[obj_id] = self.matrix[n]
+                for x, key in enumerate(row):
+                    index.bucket[(x, key)].add(obj_id)
+        return index
+
+
+def save_signatures(path, ids, matrix, hash_function=None, header=None, arrays=None):
+    """
+    Saves Superminhash signatures: `ids` the obj_ids (all strings or all ints),
+    `matrix` their values as returned by `Superminhash.build_many`,
+    `header` and `arrays` are added to the header and the stored arrays
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if len(ids) != len(matrix):
+        raise ValueError('{0} ids for {1} signatures'.format(len(ids), len(matrix)))
+
+    meta = {'kind': 'superminhash', 'length': matrix.shape[1], 'hash_function': hash_function_name(hash_function)}
+    meta.update(header or {})
+    stored = pack_ids(ids)
+    stored['signatures'] = matrix
+    stored.update(arrays or {})
+    write_store(path, meta, stored)
+
+
+def read_signatures(path, mmap=True, kind='superminhash'):
+    header, arrays = read_store(path, mmap=mmap)
+    if header.get('kind') != kind:
+        raise ValueError('{0} is not a {1} store, kind {2!r}'.format(path, kind, header.get('kind')))
+    return header, StoredIds(arrays), arrays['signatures']
+
+
+def load_signatures(path, mmap=True):
+    """
+    Signatures saved by `save_signatures`
+    return (ids, matrix): a read-only sequence of the obj_ids and the (n, length)
+    float64 matrix, memory mapped unless `mmap` is False (it can be passed to `top_k`)
+    """
+    return read_signatures(path, mmap=mmap)[1:]
+
+
+def iter_chunks(iterable, chunksize):
+    """
+    lists of `chunksize` consecutive items of `iterable` (the last one might be shorter)
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sign_stream(objs, kind='superminhash', chunksize=1024, **kwargs):
+    """
+    Signs an iterable (list, iterator or generator) of (obj_id, text_or_features)
+    `chunksize` documents at a time, `kwargs` are passed to `build_many`.
+    yield (ids, signatures) for every chunk, signatures as returned by `build_many`
+    """
+    if kind not in SIGNERS:
+        raise ValueError('kind must be one of {0}, got {1!r}'.format(', '.join(sorted(SIGNERS)), kind))
+
+    for chunk in iter_chunks(objs, chunksize):
+        yield [x[0] for x in chunk], SIGNERS[kind]([x[1] for x in chunk], **kwargs)
+
+
+def _sign_chunk(args):
+    """
+    worker of `sign_corpus`: signs `docs` into rows start.. of the shared memory matrix
+    """
+    from multiprocessing import shared_memory
+
+    name, shape, dtype, start, docs, kind, kwargs = args
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        out[start:start + len(docs)] = SIGNERS[kind](docs, **kwargs)
+        del out
+    finally:
+        shm.close()
+    return len(docs)
+
+
+SIGNERS = {'superminhash': Superminhash.build_many, 'simhash': Simhash.build_many}
+
+
+def sign_corpus(docs, kind='superminhash', length=64, workers=None, chunksize=1024, **kwargs):
+    """
+    Signatures of a corpus computed by a pool of `workers` processes
+    (all the CPUs by default, 1 signs in the current process)
+
+    `docs` is a sequence of texts or features (anything accepted by `build_many`)
+    `kind` is 'superminhash' or 'simhash'
+    `chunksize` is the number of documents signed by a task
+    `kwargs` are passed to `build_many` (reg, tokenize_slide_width, ...),
+        `hash_function` must be picklable (a backend name for instance)
+
+    The workers write their rows into a `multiprocessing.shared_memory` matrix,
+    only the documents are sent to them.
+    return the same array as `Superminhash.build_many` / `Simhash.build_many`
+    """
+    import multiprocessing
+    from multiprocessing import shared_memory
+
+    if kind not in SIGNERS:
+        raise ValueError('kind must be one of {0}, got {1!r}'.format(', '.join(sorted(SIGNERS)), kind))
+    if not hasattr(docs, '__len__'):
+        docs = list(docs)
+    kwargs['length'] = length
+
+    if workers == 1 or len(docs) <= chunksize:
+        return SIGNERS[kind](docs, **kwargs)
+
+    if kind == 'superminhash':
+        shape, dtype = (len(docs), length), np.dtype(np.float64)
+    elif length > 64:
+        shape, dtype = (len(docs), (length + 63) // 64), np.dtype(np.uint64)
+    else:
+        shape, dtype = (len(docs),), np.dtype(np.uint64)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    try:
+        tasks = ((shm.name, shape, dtype, start, docs[start:start + chunksize], kind, kwargs)
+                 for start in range(0, len(docs), chunksize))
+        pool = multiprocessing.Pool(workers)
+        try:
+            for _ in pool.imap_unordered(_sign_chunk, tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return out
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio front-end of SimhashIndex for near-duplicate services.
+
+Concurrent `query` / `add` calls are coalesced into micro-batches: the first call
+of a batch waits `window` seconds (or until `max_batch` calls are pending), then
+the whole batch is signed by `Simhash.build_many` and searched in an executor,
+so the event loop is never blocked. The index is guarded by a readers-writer lock:
+batches of queries run concurrently, `add` / `delete` run alone.
+"""
+
+import asyncio
+
+import numpy as np
+
+from superminhash import Simhash, SimhashIndex
+from superminhash.utlilits import ReadWriteLock, words_value
+
+
+def _isolated(function, items):
+    """
+    (ok, result or exception) of every item: `function(items)` is called once, and
+    when it raises, once per item so that only the failing items get the exception
+    """
+    try:
+        return [(True, x) for x in function(items)]
+    except Exception as e:
+        if len(items) == 1:
+            return [(False, e)]
+
+    ans = []
+    for item in items:
+        try:
+            ans.append((True, function([item])[0]))
+        except Exception as e:
+            ans.append((False, e))
+    return ans
+
+
+class _MicroBatcher(object):
+    """
+    Collects items and calls `function(items)` (a list of results, one per item)
+    in the executor for every batch, resolving the futures of the items;
+    an item making `function` raise fails alone (see `_isolated`)
+    """
+
+    def __init__(self, function, window, max_batch, executor):
+        self.function = function
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = executor
+        self.pending = []
+        self.handle = None
+        self.batches = 0
+        self.tasks = set()
+
+    def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.handle is None:
+            self.handle = loop.call_later(self.window, self.flush)
+        return future
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            self.batches += 1
+            task = asyncio.ensure_future(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, _isolated, self.function, [x[0] for x in batch])
+        except Exception as e:
+            results = [(False, e)] * len(batch)
+
+        for (_, future), (ok, result) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+
+class AsyncDedupIndex(object):
+
+    def __init__(self, index=None, length=64, k=2, window=0.002, max_batch=256, executor=None, **kwargs):
+        """
+        `index` is the SimhashIndex served (an empty one of `length` and `k` by default)
+        `window` is the time in seconds a batch waits for more calls
+        `max_batch` is the number of calls flushing a batch at once
+        `executor` runs the batches (the default executor of the loop if None)
+        `kwargs` are the Simhash arguments used to sign the documents (reg, hash_function, ...)
+        """
+        if index is None:
+            index = SimhashIndex([], length=length, k=k)
+        self.index = index
+        self.length = index.length
+        self.kwargs = kwargs
+        self.lock = ReadWriteLock()
+
+        self._queries = _MicroBatcher(self._query_batch, window, max_batch, executor)
+        self._adds = _MicroBatcher(self._add_batch, window, max_batch, executor)
+        self.executor = executor
+
+    @property
+    def batches(self):
+        """
+        number of batches of queries and adds run
+        """
+        return self._queries.batches + self._adds.batches
+
+    def _sign(self, docs):
+        """
+        Simhash of the documents: Simhash instances, fingerprints (int, numpy integer or
+        array of words), texts or features
+        """
+        values = [x.value if isinstance(x, Simhash) else x for x in docs]
+        values = [int(x) if isinstance(x, np.integer) else
+                  words_value(x) if isinstance(x, np.ndarray) and x.dtype == np.uint64 else x for x in values]
+        missing = [n for n, x in enumerate(values) if not isinstance(x, int)]
+        if missing:
+            signed = Simhash.build_many([values[n] for n in missing], length=self.length, **self.kwargs)
+            for n, value in zip(missing, signed):
+                values[n] = int(value) if self.length <= 64 else words_value(value)
+        return [Simhash(x, length=self.length) for x in values]
+
+    def _query_batch(self, docs):
+        simhashes = self._sign(docs)
+        with self.lock.read():
+            return [self.index.get_near_dups(x) for x in simhashes]
+
+    def _add_batch(self, items):
+        simhashes = self._sign([x[1] for x in items])
+        with self.lock.write():
+            self.index.add_many(zip([x[0] for x in items], simhashes))
+        return [None] * len(items)
+
+    def _delete(self, obj_id, doc):
+        simhash = self._sign([doc])[0]
+        with self.lock.write():
+            self.index.delete(obj_id, simhash)
+
+    async def query(self, doc):
+        """
+        obj_ids of the near duplicates of `doc` (text, features, Simhash or fingerprint)
+        """
+        return await self._queries.submit(doc)
+
+    async def add(self, obj_id, doc):
+        await self._adds.submit((obj_id, doc))
+
+    async def delete(self, obj_id, doc):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._delete, obj_id, doc)
+
+    def flush(self):
+        """
+        runs the pending batches without waiting for the end of their window
+        """
+        self._queries.flush()
+        self._adds.flush()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the signature building, similarity and index query paths.
+
+    python -m superminhash.benchmark --sizes 100 1000 --lengths 64 128 256 > baseline.json
+
+Every benchmark runs on a reproducible synthetic corpus (seeded word sampling) and
+reports its throughput and the peak memory traced by tracemalloc, as JSON.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from superminhash import Simhash, SimhashIndex, Superminhash
+
+WORDS = 2000
+WORDS_PER_DOC = 80
+
+
+def synthetic_corpus(size, seed=0, words=WORDS, words_per_doc=WORDS_PER_DOC, duplicates=0.2):
+    """
+    `size` texts of `words_per_doc` words drawn from a vocabulary of `words` made up words,
+    a fraction `duplicates` of them being near duplicates (one word changed) of earlier texts
+    """
+    rng = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    vocabulary = [''.join(rng.choice(letters, rng.randint(3, 10))) for _ in range(words)]
+
+    docs = []
+    for n in range(size):
+        if n and rng.uniform() < duplicates:
+            doc = docs[rng.randint(n)].split()
+            doc[rng.randint(len(doc))] = vocabulary[rng.randint(words)]
+        else:
+            doc = [vocabulary[x] for x in rng.randint(words, size=words_per_doc)]
+        docs.append(' '.join(doc))
+    return docs
+
+
+def measure(name, function, count, **info):
+    """
+    runs `function()` twice: timed, then under tracemalloc (which slows it down)
+    to get its peak memory; `count` is the number of operations it performs
+    return the result record: info, seconds, throughput (operations per second), peak_memory (bytes)
+    """
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    record = {'name': name, 'operations': count, 'seconds': seconds,
+              'throughput': count / seconds if seconds > 0 else None, 'peak_memory': peak_memory}
+    record.update(info)
+    return record
+
+
+def run(sizes=(100, 1000), lengths=(64, 128, 256), k=3, queries=100, seed=0):
+    """
+    return the list of the benchmark records for every corpus size and signature length
+    """
+    results = []
+    for size in sizes:
+        docs = synthetic_corpus(size, seed=seed)
+        probes = docs[:min(queries, size)]
+        pairs = list(zip(probes, reversed(probes)))
+
+        for length in lengths:
+            info = {'docs': size, 'length': length}
+
+            results.append(measure('simhash_build', lambda: [Simhash(doc, length=length) for doc in docs],
+                                   size, **info))
+            results.append(measure('simhash_build_many', lambda: Simhash.build_many(docs, length=length),
+                                   size, **info))
+            results.append(measure('superminhash_build', lambda: [Superminhash(doc, length=length) for doc in docs],
+                                   size, **info))
+            results.append(measure('superminhash_build_many',
+                                   lambda: Superminhash.build_many(docs, length=length), size, **info))
+
+            shs = dict((doc, Simhash(doc, length=length)) for doc in probes)
+            smhs = dict((doc, Superminhash(doc, length=length)) for doc in probes)
+            results.append(measure('simhash_distance', lambda: [shs[a].distance(shs[b]) for a, b in pairs],
+                                   len(pairs), **info))
+            results.append(measure('superminhash_similarity',
+                                   lambda: [smhs[a].similarity(smhs[b]) for a, b in pairs], len(pairs), **info))
+
+            objs = [(str(n), Simhash(doc, length=length)) for n, doc in enumerate(docs)]
+            results.append(measure('simhash_index_add', lambda: SimhashIndex(objs, length=length, k=k),
+                                   size, k=k, **info))
+            index = SimhashIndex(objs, length=length, k=k)
+            results.append(measure('simhash_index_get_near_dups',
+                                   lambda: [index.get_near_dups(shs[doc]) for doc in probes], len(probes),
+                                   k=k, **info))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000], help='corpus sizes')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[64, 128, 256], help='signature lengths')
+    parser.add_argument('--k', type=int, default=3, help='SimhashIndex tolerance')
+    parser.add_argument('--queries', type=int, default=100, help='number of queries and compared pairs')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpora')
+    parser.add_argument('--output', help='JSON file to write (standard output by default)')
+    args = parser.parse_args(argv)
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'results': run(args.sizes, args.lengths, args.k, args.queries, args.seed),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Index sharded over several local indexes, in the current process or in worker processes.
+
+The entries are partitioned by a stable hash of their obj_id: every shard owns a
+SimhashIndex (or a SuperminhashLSHIndex) holding its part. Inserts and deletes go to
+the shard of the obj_id, bulk inserts are grouped by shard and sent to all the shards
+at once, queries are broadcast to every shard and their results merged (scatter-gather).
+
+    with ShardedIndex(shards=8, transport='process', length=64, k=3) as index:
+        index.add_many(docs)
+        dups = index.query(text)
+
+With the 'process' transport each shard lives in its own process, so the index is
+not limited by the memory of one process and the shards search in parallel.
+"""
+
+import multiprocessing
+import zlib
+
+import numpy as np
+
+from superminhash import Simhash, SimhashIndex, Superminhash, SuperminhashLSHIndex, iter_chunks
+from superminhash.utlilits import words_value
+
+INDEXES = {'simhash': SimhashIndex, 'superminhash': SuperminhashLSHIndex}
+
+
+def shard_of(obj_id, shards):
+    """
+    shard (0..shards - 1) of `obj_id`, the same in every process and every run
+    """
+    return zlib.crc32(str(obj_id).encode('utf-8')) % shards
+
+
+def _new_index(kind, kwargs):
+    if kind not in INDEXES:
+        raise ValueError('kind must be one of {0}, got {1!r}'.format(', '.join(sorted(INDEXES)), kind))
+    return INDEXES[kind]([], **kwargs)
+
+
+def _call(index, method, args, kwargs):
+    """
+    runs `index.method(*args, **kwargs)`; the 'map' method runs `index.name(*x, **kwargs)`
+    for every x of `items` given as args (name, items) and returns the list of the results
+    """
+    if method == 'map':
+        name, items = args
+        function = getattr(index, name)
+        return [function(*x, **kwargs) for x in items]
+    return getattr(index, method)(*args, **kwargs)
+
+
+class LocalTransport(object):
+    """
+    The shards as indexes of the current process, called one after the other
+    """
+
+    def __init__(self, shards, kind='simhash', kwargs=None):
+        self.indexes = [_new_index(kind, kwargs or {}) for _ in range(shards)]
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def scatter(self, requests):
+        """
+        `requests` is a list of (shard, method, args, kwargs)
+        return the list of the results, in the order of `requests`
+        """
+        return [_call(self.indexes[shard], *request) for shard, *request in requests]
+
+    def close(self):
+        self.indexes = []
+
+
+def _serve(conn, kind, kwargs):
+    """
+    worker of `ProcessTransport`: answers the (method, args, kwargs) requests received on `conn`
+    with (True, result) or (False, exception) until None is received
+    """
+    index = _new_index(kind, kwargs)
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        try:
+            conn.send((True, _call(index, *request)))
+        except Exception as e:
+            conn.send((False, e))
+    conn.close()
+
+
+class ProcessTransport(object):
+    """
+    One worker process per shard, owning its index; the requests are pickled
+    through pipes and the shards of a `scatter` process them in parallel
+    """
+
+    def __init__(self, shards, kind='simhash', kwargs=None, context=None):
+        """
+        `context` is the multiprocessing context (or start method name) of the workers
+        """
+        if context is None or isinstance(context, str):
+            context = multiprocessing.get_context(context)
+        _new_index(kind, kwargs or {})
+
+        self.conns = []
+        self.processes = []
+        for _ in range(shards):
+            parent, child = context.Pipe()
+            process = context.Process(target=_serve, args=(child, kind, kwargs or {}), daemon=True)
+            process.start()
+            child.close()
+            self.conns.append(parent)
+            self.processes.append(process)
+
+    def __len__(self):
+        return len(self.conns)
+
+    def scatter(self, requests):
+        """
+        `requests` is a list of (shard, method, args, kwargs), at most one per shard is in flight:
+        the requests are sent to all their shards before any answer is read
+        return the list of the results, in the order of `requests`
+        """
+        results = [None] * len(requests)
+        pending = list(enumerate(requests))
+        while pending:
+            batch, later, busy = [], [], set()
+            for n, request in pending:
+                (later if request[0] in busy else batch).append((n, request))
+                busy.add(request[0])
+            for _, (shard, *request) in batch:
+                self.conns[shard].send(tuple(request))
+
+            error = None
+            for n, (shard, *_) in batch:
+                ok, result = self.conns[shard].recv()
+                if ok:
+                    results[n] = result
+                elif error is None:
+                    error = result
+            if error is not None:
+                raise error
+            pending = later
+        return results
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+                conn.close()
+            except (OSError, EOFError):
+                pass
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.conns, self.processes = [], []
+
+
+TRANSPORTS = {'local': LocalTransport, 'process': ProcessTransport}
+
+
+class ShardedIndex(object):
+
+    def __init__(self, shards=4, kind='simhash', transport='local', **kwargs):
+        """
+        `shards` is the number of partitions of the entries
+        `kind` is 'simhash' (shards of SimhashIndex) or 'superminhash' (SuperminhashLSHIndex)
+        `transport` is 'local' (in-process shards), 'process' (a worker process per shard)
+            or a transport class called with (shards, kind, kwargs)
+        `kwargs` are the arguments of the index of every shard (length, k, threshold, ...)
+        """
+        if kind not in INDEXES:
+            raise ValueError('kind must be one of {0}, got {1!r}'.format(', '.join(sorted(INDEXES)), kind))
+        if not isinstance(transport, type):
+            if transport not in TRANSPORTS:
+                raise ValueError('transport must be one of {0}, got {1!r}'.format(', '.join(sorted(TRANSPORTS)),
+                                                                                 transport))
+            transport = TRANSPORTS[transport]
+
+        self.shards = shards
+        self.kind = kind
+        self.length = kwargs.get('length', 64)
+        self.transport = transport(shards, kind, kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.transport.close()
+
+    def shard(self, obj_id):
+        return shard_of(obj_id, self.shards)
+
+    def _signed(self, value):
+        """
+        `value` in the form sent to the shards: the fingerprint (int) of a Simhash
+        (given as int, numpy integer or array of words), the values array of a
+        Superminhash, None for a text or features
+        """
+        if self.kind == 'simhash':
+            value = getattr(value, 'value', value)
+            if isinstance(value, (int, np.integer)):
+                return int(value)
+            if isinstance(value, np.ndarray) and value.dtype == np.uint64:
+                return words_value(value)
+            return None
+        value = getattr(value, 'values', value)
+        return np.asarray(value, dtype=np.float64) if isinstance(value, np.ndarray) else None
+
+    def _sign(self, value, kwargs):
+        signed = self._signed(value)
+        if signed is not None:
+            return signed
+        if self.kind == 'simhash':
+            return Simhash(value, length=self.length, **kwargs).value
+        return Superminhash(value, length=self.length, **kwargs).values
+
+    def _signature(self, value, kwargs):
+        """
+        the signature searched by the shards: a Simhash or a values array
+        """
+        value = self._sign(value, kwargs)
+        return Simhash(value, length=self.length) if self.kind == 'simhash' else value
+
+    def add(self, obj_id, value, **kwargs):
+        """
+        `value` is a Simhash / Superminhash, its signature or a text or features
+        signed by its shard (`kwargs` are the signature arguments)
+        """
+        self.add_many([(obj_id, value)], **kwargs)
+
+    def add_many(self, objs, chunksize=1024, **kwargs):
+        """
+        Bulk load of an iterable of (obj_id, value), read `chunksize` items at a time:
+        the items of a chunk are grouped by shard and every shard loads its group
+        with `add_many` (texts and features are signed by the shards)
+        return the number of items loaded
+        """
+        count = 0
+        for chunk in iter_chunks(objs, chunksize):
+            groups = {}
+            for obj_id, value in chunk:
+                signed = self._signed(value)
+                docs, signatures = groups.setdefault(self.shard(obj_id), ([], []))
+                if signed is None:
+                    docs.append((obj_id, value))
+                else:
+                    signatures.append((obj_id, signed))
+
+            requests = []
+            for shard, (docs, signatures) in sorted(groups.items()):
+                if self.kind == 'simhash':
+                    requests.append((shard, 'add_many', (docs + signatures, chunksize), kwargs))
+                else:
+                    if signatures:
+                        requests.append((shard, 'map', ('add', signatures), {}))
+                    if docs:
+                        requests.append((shard, 'add_many', (docs, chunksize), kwargs))
+            self.transport.scatter(requests)
+            count += len(chunk)
+
+        return count
+
+    def delete(self, obj_id, value, **kwargs):
+        self.transport.scatter([(self.shard(obj_id), 'delete', (obj_id, self._signature(value, kwargs)), {})])
+
+    def query(self, value, threshold=None, **kwargs):
+        """
+        near duplicates of `value` in all the shards:
+            simhash: a list of obj_id
+            superminhash: a list of (obj_id, similarity) by decreasing similarity (see SuperminhashLSHIndex.query)
+        """
+        return self.query_many([value], threshold=threshold, **kwargs)[0]
+
+    def query_many(self, values, threshold=None, **kwargs):
+        """
+        results of `query` for every value, with one request per shard for all the values
+        """
+        signatures = [self._signature(x, kwargs) for x in values]
+        if self.kind == 'simhash':
+            items = [(x,) for x in signatures]
+            method = 'get_near_dups'
+        else:
+            items = [(x, threshold) for x in signatures]
+            method = 'query'
+
+        results = self.transport.scatter([(shard, 'map', (method, items), {}) for shard in range(self.shards)])
+        ans = []
+        for n in range(len(signatures)):
+            merged = [x for shard in results for x in shard[n]]
+            if self.kind == 'superminhash':
+                merged.sort(key=lambda x: -x[1])
+            ans.append(merged)
+        return ans
+
+    def bucket_size(self):
+        return sum(self.transport.scatter([(shard, 'bucket_size', (), {}) for shard in range(self.shards)]))
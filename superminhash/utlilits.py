@@ -8,22 +8,971 @@ Created on Sat Jan 20 15:09:52 2018
 import numpy as np
 import sys
 import collections
-from itertools import groupby
 import re
-import copy
+import hashlib
+import json
+import os
+import tempfile
+import struct
+import threading
+import contextlib
+
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
 
 if sys.version_info[0] >= 3:
     basestring = str
     unicode = str
     long = int
-    dict_items = type({}.items())
 else:
     range = xrange
 
 MAX_UINT32 = np.iinfo(np.uint32).max
+MAX_UINT64 = np.iinfo(np.uint64).max
+
+_MASK64 = (1 << 64) - 1
+_SPLITMIX64_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_SPLITMIX64_MUL1 = np.uint64(0xBF58476D1CE4E5B9)
+_SPLITMIX64_MUL2 = np.uint64(0x94D049BB133111EB)
+
+# number of features expanded at once by the batched Superminhash engine,
+# bounds the temporary (chunk, length) matrices
+SUPERMINHASH_CHUNKSIZE = 4096
+
+# number of stored signatures compared at once by `similarity_matrix` and `top_k`,
+# bounds the temporary (chunk, length) comparison matrices
+SIMILARITY_CHUNKSIZE = 65536
+
+
+def splitmix64(x):
+    """
+    splitmix64 finalizer applied element-wise to an uint64 array,
+    arithmetic wraps modulo 2 ** 64
+    """
+    z = np.array(x, dtype=np.uint64, ndmin=1)
+    z ^= z >> np.uint64(30)
+    z *= _SPLITMIX64_MUL1
+    z ^= z >> np.uint64(27)
+    z *= _SPLITMIX64_MUL2
+    z ^= z >> np.uint64(31)
+    return z
+
+
+def superminhash_sequence(hashes, length):
+    """
+    Counter-based random sequence of the features keyed by their 64-bit hashes.
+
+    The n-th draw of a feature with hash `h` is splitmix64(h + (n + 1) * GAMMA),
+    draws 0 .. length - 1 are the permutation keys and draws
+    length .. 2 * length - 1 give the uniform `r` values in [0, 1) (upper 53 bits).
+
+    return (perm, r), both of shape (len(hashes), length):
+        perm[f] is the permutation of the signature slots for feature f
+        (argsort of its keys), r[f] the float64 uniforms
+    """
+    hashes = np.array(hashes, dtype=np.uint64, ndmin=1)
+    counters = np.arange(1, 2 * length + 1, dtype=np.uint64) * _SPLITMIX64_GAMMA
+    draws = splitmix64(hashes[:, None] + counters[None, :])
+
+    perm = np.argsort(draws[:, :length], axis=1, kind='stable')
+    r = (draws[:, length:] >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+    return perm, r
+
+
+class HashFunction(object):
+    """
+    Hash backend: `function` hashes one token (str or utf-8 bytes) to an unsigned int,
+    `many_function(tokens, words)` hashes a list of tokens at once to an uint64 array
+    of shape (len(tokens), words), word w holding the bits [64 * w, 64 * (w + 1)).
+    Backends without `many_function` hash the tokens one by one.
+    """
+
+    __slots__ = ('name', 'function', 'many_function')
+
+    def __init__(self, name, function, many_function=None):
+        self.name = name
+        self.function = function
+        self.many_function = many_function
+
+    def __call__(self, x):
+        return self.function(x)
+
+    def __repr__(self):
+        return 'HashFunction({0!r})'.format(self.name)
+
+    def __reduce__(self):
+        if type(self) is HashFunction and HASH_FUNCTIONS.get(self.name) is self:
+            return get_hash_function, (self.name,)
+        return object.__reduce_ex__(self, 2)
+
+    def many(self, tokens, words=1):
+        if self.many_function is not None:
+            return self.many_function(tokens, words)
+        return np.array([fingerprint_words(self.function(token), 64 * words) for token in tokens],
+                        dtype=np.uint64).reshape(-1, words)
+
+
+def md5_hash(x):
+    """
+    128-bit MD5 digest of `x` as an int, the original fingerprints of the package
+    """
+    if isinstance(x, unicode):
+        x = x.encode('utf-8')
+    return int(hashlib.md5(x).hexdigest(), 16)
+
+
+def splitmix64_hash_many(tokens, words=1):
+    """
+    Vectorized non-cryptographic hash of a list of tokens (str or bytes).
+
+    The bytes of every token are read as little-endian 64-bit blocks (zero padded),
+    word w of the hash starts from splitmix64(len + w * GAMMA) and mixes each block
+    in by h = splitmix64((h ^ block) + GAMMA). The tokens with the same number of
+    blocks are processed together, one numpy pass per block, so a long token does
+    not pad the others.
+
+    return uint64 array of shape (len(tokens), words)
+    """
+    data = [x.encode('utf-8') if isinstance(x, unicode) else bytes(x) for x in tokens]
+    out = np.empty((len(data), words), dtype=np.uint64)
+    if not data:
+        return out
+
+    lengths = np.fromiter((len(x) for x in data), dtype=np.uint64, count=len(data))
+    nblocks = (lengths + np.uint64(7)) // np.uint64(8)
+    order = np.argsort(nblocks, kind='stable')
+    widths, starts = np.unique(nblocks[order], return_index=True)
+
+    for width, group in zip(widths.tolist(), np.split(order, starts[1:])):
+        if width:
+            packed = np.array([data[n] for n in group.tolist()], dtype='S%d' % (8 * width))
+            blocks = np.frombuffer(packed.tobytes(), dtype='<u8').reshape(-1, width)
+        for w in range(words):
+            h = splitmix64(lengths[group] + np.uint64(w) * _SPLITMIX64_GAMMA)
+            for c in range(width):
+                h = splitmix64((h ^ blocks[:, c]) + _SPLITMIX64_GAMMA)
+            out[group, w] = h
+    return out
+
+
+def splitmix64_hash(x):
+    """
+    64-bit hash of one token by `splitmix64_hash_many`
+    """
+    return int(splitmix64_hash_many([x])[0, 0])
+
+
+class LRUCache(object):
+    """
+    Thread-safe bounded mapping evicting the least recently used items beyond `maxsize`,
+    `hits` and `misses` count the lookups by `get`. A cache can be shared by many
+    Simhash / Superminhash instances (see their `cache` and `doc_cache` arguments).
+    """
+
+    def __init__(self, maxsize=65536):
+        if maxsize <= 0:
+            raise ValueError('maxsize must be positive, got {0}'.format(maxsize))
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """
+        dict of the hits, misses, current size and maxsize of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class CachedHashFunction(HashFunction):
+    """
+    Hash backend memoizing the hashes of the tokens of `backend` in an LRUCache
+
+    Only the backends hashing the tokens one by one (MD5, custom callables) are
+    memoized: a vectorized backend (with a `many_function`, like 'splitmix64') is
+    faster than the cache lookups and is called directly.
+    The keys of an unnamed backend hold its function, so they can not match the
+    hashes of another function created later at the same address.
+    """
+
+    __slots__ = ('backend', 'cache')
+
+    def __init__(self, backend, cache):
+        if not isinstance(backend, HashFunction):
+            backend = HashFunction(None, backend)
+        HashFunction.__init__(self, backend.name, backend.function)
+        self.backend = backend
+        self.cache = cache
+
+    def many(self, tokens, words=1):
+        if self.backend.many_function is not None:
+            return self.backend.many(tokens, words)
+
+        keys = [(self.name if self.name is not None else self.function, token, words) for token in tokens]
+        rows = [self.cache.get(key) for key in keys]
+
+        missing = [n for n, row in enumerate(rows) if row is None]
+        if missing:
+            hashes = self.backend.many([tokens[n] for n in missing], words)
+            for x, n in enumerate(missing):
+                rows[n] = hashes[x].copy()
+                self.cache.put(keys[n], rows[n])
+
+        return np.array(rows, dtype=np.uint64).reshape(len(rows), words)
+
+
+def document_digest(content, *args):
+    """
+    cache key of a document text signed with the arguments `args`
+    """
+    return (hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest(),) + args
+
+
+def cached_signatures(docs, doc_cache, key_args, build, shape, dtype):
+    """
+    Signatures of `docs` through the LRUCache `doc_cache` of the texts by digest:
+    the signatures of the texts not in the cache (and of the other documents) are
+    computed by `build(docs)` and stored.
+
+    `key_args` : arguments of the signing (kind, length, hash function, ...) added to the keys
+    `shape`, `dtype` : shape of one signature and dtype of the output
+    """
+    docs = list(docs)
+    keys = [document_digest(doc, *key_args) if isinstance(doc, basestring) else None for doc in docs]
+    rows = [doc_cache.get(key) if key is not None else None for key in keys]
+
+    out = np.empty((len(docs),) + tuple(shape), dtype=dtype)
+    missing = [n for n, row in enumerate(rows) if row is None]
+    if missing:
+        built = build([docs[n] for n in missing])
+        for x, n in enumerate(missing):
+            rows[n] = built[x].copy()
+            if keys[n] is not None:
+                doc_cache.put(keys[n], rows[n])
+
+    for n, row in enumerate(rows):
+        out[n] = row
+    return out
+
+
+class ReadWriteLock(object):
+    """
+    Readers-writer lock: any number of readers or one writer; waiting writers
+    block new readers so that they are not starved.
+
+        with lock.read():
+            ...
+        with lock.write():
+            ...
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def size_histogram(sizes):
+    """
+    histogram of `sizes` by powers of two: {upper bound: count}, the bound b counting
+    the sizes in (b / 2, b] (1 counts the sizes 0 and 1)
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if not len(sizes):
+        return {}
+    bounds = np.left_shift(1, np.ceil(np.log2(np.maximum(sizes, 1))).astype(np.int64))
+    uniques, counts = np.unique(bounds, return_counts=True)
+    return dict(zip(uniques.tolist(), counts.tolist()))
+
+
+def bucket_stats(sizes):
+    """
+    distribution of bucket sizes: number of buckets, entries, min, max, mean,
+    p50 / p90 / p99 and the power of two `histogram`
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if not len(sizes):
+        return {'buckets': 0, 'entries': 0, 'min': 0, 'max': 0, 'mean': 0., 'p50': 0., 'p90': 0., 'p99': 0.,
+                'histogram': {}}
+    p50, p90, p99 = np.percentile(sizes, [50, 90, 99]).tolist()
+    return {'buckets': len(sizes), 'entries': int(sizes.sum()), 'min': int(sizes.min()), 'max': int(sizes.max()),
+            'mean': float(sizes.mean()), 'p50': p50, 'p90': p90, 'p99': p99, 'histogram': size_histogram(sizes)}
+
+
+class IndexMetrics(object):
+    """
+    Collector of SimhashIndex query metrics, pass it as `metrics` to the index.
+
+    Any object with a `record_query(candidates, matches, key_seconds, distance_seconds, bucket_sizes)`
+    method can be used instead (to forward the metrics to a monitoring system).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.candidates = 0
+            self.matches = 0
+            self.key_seconds = 0.
+            self.distance_seconds = 0.
+            self.max_candidates = 0
+            self.candidates_histogram = collections.Counter()
+            self.bucket_histogram = collections.Counter()
+
+    def record_query(self, candidates, matches, key_seconds, distance_seconds, bucket_sizes):
+        """
+        `candidates` scanned and `matches` returned by one query, seconds spent in key
+        generation and in distance checks, sizes of the buckets visited
+        """
+        with self._lock:
+            self.queries += 1
+            self.candidates += candidates
+            self.matches += matches
+            self.key_seconds += key_seconds
+            self.distance_seconds += distance_seconds
+            self.max_candidates = max(self.max_candidates, candidates)
+            self.candidates_histogram.update(size_histogram([candidates]))
+            self.bucket_histogram.update(size_histogram(bucket_sizes))
+
+    def summary(self):
+        """
+        dict of the totals, per query means and histograms (candidates per query,
+        sizes of the buckets visited)
+        """
+        with self._lock:
+            queries = max(self.queries, 1)
+            return {'queries': self.queries, 'candidates': self.candidates, 'matches': self.matches,
+                    'mean_candidates': self.candidates / float(queries), 'max_candidates': self.max_candidates,
+                    'mean_matches': self.matches / float(queries),
+                    'key_seconds': self.key_seconds, 'distance_seconds': self.distance_seconds,
+                    'candidates_histogram': dict(self.candidates_histogram),
+                    'bucket_histogram': dict(self.bucket_histogram)}
+
+
+HASH_FUNCTIONS = {}
+
+
+def register_hash_function(name, function, many_function=None):
+    """
+    Registers a hash backend selectable by `name` as `hash_function` of Simhash and Superminhash
+    """
+    HASH_FUNCTIONS[name] = HashFunction(name, function, many_function)
+    return HASH_FUNCTIONS[name]
+
+
+register_hash_function('md5', md5_hash)
+register_hash_function('splitmix64', splitmix64_hash, splitmix64_hash_many)
+
+DEFAULT_HASH_FUNCTION = 'md5'
+
+
+def get_hash_function(hash_function=None):
+    """
+    hash backend: `hash_function` is a name of HASH_FUNCTIONS, a callable (returned as is)
+    or None for the default backend
+    """
+    if hash_function is None:
+        hash_function = DEFAULT_HASH_FUNCTION
+    if isinstance(hash_function, basestring):
+        try:
+            return HASH_FUNCTIONS[hash_function]
+        except KeyError:
+            raise ValueError('unknown hash function {0!r}, registered: {1}'.format(
+                hash_function, ', '.join(sorted(HASH_FUNCTIONS))))
+    return hash_function
+
+
+def superminhash_candidates(hashes, length, width=None, cache=None):
+    """
+    Candidate values of the features, float64 array of shape (len(hashes), length):
+    slot perm[j] of a feature holds j + r[j] for j < `width`, inf for the others
+
+    `cache` is an optional LRUCache of the full (candidates, perm) rows by feature hash
+
+    return (candidates, perm)
+    """
+    if cache is not None:
+        return _cached_superminhash_candidates(hashes, length, width, cache)
+
+    perm, r = superminhash_sequence(hashes, length)
+    if width is None:
+        width = length
+
+    candidates = np.full((len(perm), length), np.inf)
+    np.put_along_axis(candidates, perm[:, :width], r[:, :width] + np.arange(width), axis=1)
+    return candidates, perm
+
+
+def _cached_superminhash_candidates(hashes, length, width, cache):
+    hashes = np.array(hashes, dtype=np.uint64, ndmin=1)
+    keys = [('superminhash', h, length) for h in hashes.tolist()]
+    rows = [cache.get(key) for key in keys]
+
+    missing = [n for n, row in enumerate(rows) if row is None]
+    if missing:
+        candidates, perm = superminhash_candidates(hashes[missing], length)
+        for x, n in enumerate(missing):
+            rows[n] = (candidates[x].copy(), perm[x].copy())
+            cache.put(keys[n], rows[n])
+
+    candidates = np.array([row[0] for row in rows]).reshape(len(rows), length)
+    perm = np.array([row[1] for row in rows], dtype=np.int64).reshape(len(rows), length)
+    if width is not None and width < length:
+        candidates[candidates >= width] = np.inf
+    return candidates, perm
+
+
+def superminhash_push_hashes(hashes, values, q, p, b, i, a, chunksize=None, cache=None):
+    """
+    Batched Superminhash update, pushes all the feature `hashes` (uint64) at once.
+
+    For the feature number `i` (in push order) with permutation `perm` and uniforms `r`
+    slot perm[j] receives the candidate j + r[j], the signature value of a slot is
+    the minimum candidate over all pushed features. Only j <= `a` can lower a value
+    (all values are below a + 1), so the rest of the permutation is skipped.
+
+    `values`, `q`, `p`, `b` are numpy arrays updated in place:
+        `q[k]` is the number of the feature which set values[k] (-1 if none yet),
+        `p` is the permutation of the last pushed feature,
+        `b[x]` is the count of values with floor(values) == x (capped to length - 1)
+    return (values, q, p, b, i, a)
+    """
+    hashes = np.array(hashes, dtype=np.uint64, ndmin=1)
+    length = len(values)
+    if chunksize is None:
+        chunksize = SUPERMINHASH_CHUNKSIZE
+
+    for start in range(0, len(hashes), chunksize):
+        chunk = hashes[start:start + chunksize]
+        candidates, perm = superminhash_candidates(chunk, length, width=a + 1, cache=cache)
+
+        winner = candidates.argmin(axis=0)
+        best = candidates[winner, np.arange(length)]
+        lower = best < values
+        values[lower] = best[lower]
+        q[lower] = i + winner[lower]
+
+        p[:] = perm[-1]
+        i += len(chunk)
+
+        b[:] = np.bincount(np.minimum(values, length - 1).astype(np.int64), minlength=length)
+        a = int(np.flatnonzero(b)[-1])
+
+    return values, q, p, b, i, a
+
+
+def _uniforms(draws):
+    """
+    uniforms in (0, 1) from uint64 draws (upper 53 bits, centered)
+    """
+    return ((draws >> np.uint64(11)).astype(np.float64) + 0.5) * (1.0 / (1 << 53))
+
+
+def weighted_superminhash_candidates(hashes, weights, length):
+    """
+    Weighted candidates (consistent weighted sampling, Ioffe's ICWS), float64 array
+    of shape (len(hashes), length).
+
+    For the feature f of weight w and the slot k, the splitmix64 sequence of f
+    (draws 5 * k .. 5 * k + 4) gives r, c ~ Gamma(2, 1) and beta ~ U(0, 1);
+    with t = floor(ln(w) / r + beta) the candidate is ln(c) - r * (t - beta) - r,
+    the log of ICWS's `a`. It only depends on (f, k, t), so the slot minimum of two
+    weighted sets is the same with probability their weighted Jaccard similarity
+    sum(min(w, w')) / sum(max(w, w')). Features with a weight <= 0 give inf.
+    """
+    hashes = np.array(hashes, dtype=np.uint64, ndmin=1)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    counters = np.arange(1, 5 * length + 1, dtype=np.uint64) * _SPLITMIX64_GAMMA
+    u = _uniforms(splitmix64(hashes[:, None] + counters[None, :])).reshape(len(hashes), length, 5)
+
+    r = -np.log(u[..., 0] * u[..., 1])
+    log_c = np.log(-np.log(u[..., 2] * u[..., 3]))
+    beta = u[..., 4]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_w = np.log(weights)[:, None]
+        t = np.floor(log_w / r + beta)
+        candidates = log_c - r * (t - beta) - r
+    candidates[~(weights > 0)] = np.inf
+    return candidates
+
+
+def weighted_superminhash_push_hashes(hashes, weights, values, q, i, chunksize=None):
+    """
+    Batched weighted Superminhash update: pushes the feature `hashes` (uint64) with their
+    `weights` at once, the value of a slot is the minimum weighted candidate
+    (`weighted_superminhash_candidates`) and q[k] the number of the feature which set it.
+    `values` and `q` are updated in place
+    return (values, q, i)
+    """
+    hashes = np.array(hashes, dtype=np.uint64, ndmin=1)
+    weights = np.array(weights, dtype=np.float64, ndmin=1)
+    length = len(values)
+    if chunksize is None:
+        chunksize = SUPERMINHASH_CHUNKSIZE
+
+    for start in range(0, len(hashes), chunksize):
+        candidates = weighted_superminhash_candidates(hashes[start:start + chunksize],
+                                                      weights[start:start + chunksize], length)
+        winner = candidates.argmin(axis=0)
+        best = candidates[winner, np.arange(length)]
+        lower = best < values
+        values[lower] = best[lower]
+        q[lower] = i + winner[lower]
+        i += len(candidates)
+
+    return values, q, i
+
+
+def superminhash_merge_states(state, other, weighted=False):
+    """
+    Superminhash state (values, q, p, b, i, a) of the union of the features of two states.
+
+    The values are the element-wise minimum; `q` keeps the feature numbers of the
+    winning side, the features of `other` being numbered after the `i` ones of `state`;
+    `p` is the permutation of the last feature of `other`; `b` and `a` are recounted
+    from the merged values, so that further pushes stay valid (they are kept as is
+    for `weighted` signatures, which do not use them).
+    The input arrays are not modified.
+    """
+    values, q, p, b, i, a = state
+    values2, q2, p2, b2, i2, a2 = other
+    if len(values) != len(values2):
+        raise ValueError("signatures not of same length, {0} and {1}".format(len(values), len(values2)))
+    length = len(values)
+
+    lower = values2 < values
+    values = np.where(lower, values2, values)
+    q = np.where(lower, np.where(q2 >= 0, q2 + i, q2), q)
+    p = (p2 if i2 else p).copy()
+    if weighted:
+        return values, q, p, b.copy(), i + i2, a
+    b = np.bincount(np.minimum(values, length - 1).astype(np.int64), minlength=length)
+    a = int(np.flatnonzero(b)[-1])
+
+    return values, q, p, b, i + i2, a
+
+
+def superminhash_hash_features(features, hash_function):
+    """
+    64-bit hashes (uint64 array) of `features`, lower 64 bits of `hash_function`
+    """
+    if isinstance(hash_function, HashFunction):
+        return hash_function.many(features)[:, 0]
+    return np.fromiter((hash_function(feature) & _MASK64 for feature in features), dtype=np.uint64)
+
+
+def superminhash_signature_matrix(hashes, counts, length, chunksize=None, weights=None, cache=None):
+    """
+    Signatures of many documents at once.
+
+    `hashes` : uint64 array of the feature hashes of all documents, concatenated
+    `counts` : number of features of every document
+    `weights`: weights of the features for weighted signatures, concatenated as `hashes`
+    `cache`  : optional LRUCache of the candidates of the features (unweighted signatures)
+
+    return float64 array of shape (len(counts), length), row n is the `values`
+    of the Superminhash built from the features of the document n
+    """
+    hashes = np.array(hashes, dtype=np.uint64, ndmin=1)
+    counts = np.asarray(counts, dtype=np.int64)
+    if chunksize is None:
+        chunksize = SUPERMINHASH_CHUNKSIZE
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+
+    out = np.full((len(counts), length), MAX_UINT32, dtype=np.float64)
+    doc_index = np.repeat(np.arange(len(counts)), counts)
+
+    for start in range(0, len(hashes), chunksize):
+        if weights is None:
+            candidates, _ = superminhash_candidates(hashes[start:start + chunksize], length, cache=cache)
+        else:
+            candidates = weighted_superminhash_candidates(hashes[start:start + chunksize],
+                                                          weights[start:start + chunksize], length)
+
+        idx = doc_index[start:start + chunksize]
+        starts = np.flatnonzero(np.r_[True, idx[1:] != idx[:-1]])
+        docs = idx[starts]
+        out[docs] = np.minimum(out[docs], np.minimum.reduceat(candidates, starts, axis=0))
+
+    return out
+
+
+def similarity_matrix(A, B, chunksize=None):
+    """
+    Superminhash similarities of all the pairs of signatures
+
+    `A` : array of shape (n, length) or (length,)
+    `B` : array of shape (m, length) or (length,)
+
+    return float64 array of shape (n, m), item [x, y] is the fraction of equal values of A[x] and B[y]
+    """
+    A = np.atleast_2d(A)
+    B = np.atleast_2d(B)
+    if A.shape[1] != B.shape[1]:
+        raise ValueError('signatures not of same length, {0} and {1}'.format(A.shape[1], B.shape[1]))
+    if chunksize is None:
+        chunksize = max(SIMILARITY_CHUNKSIZE // max(len(A), 1), 1)
+
+    out = np.empty((len(A), len(B)), dtype=np.float64)
+    for start in range(0, len(B), chunksize):
+        chunk = np.asarray(B[start:start + chunksize])
+        out[:, start:start + len(chunk)] = (A[:, None, :] == chunk[None, :, :]).sum(axis=2)
+
+    out /= A.shape[1]
+    return out
+
+
+def top_k(query, matrix, k, chunksize=None):
+    """
+    The `k` signatures of `matrix` most similar to `query`
+
+    `query`  : signature values, array of shape (length,)
+    `matrix` : array of shape (n, length), might be a np.memmap, it is read by chunks
+
+    return (indices, scores) sorted by decreasing score, ties by increasing index
+    """
+    query = np.asarray(query)
+    if matrix.shape[1] != len(query):
+        raise ValueError('signatures not of same length, {0} and {1}'.format(len(query), matrix.shape[1]))
+    if chunksize is None:
+        chunksize = SIMILARITY_CHUNKSIZE
+
+    indices = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    if k <= 0:
+        return indices, counts.astype(np.float64)
+
+    for start in range(0, len(matrix), chunksize):
+        chunk = np.asarray(matrix[start:start + chunksize])
+        indices = np.concatenate((indices, np.arange(start, start + len(chunk), dtype=np.int64)))
+        counts = np.concatenate((counts, (chunk == query).sum(axis=1)))
+
+        if len(counts) > k:
+            keep = np.argpartition(-counts, k - 1)[:k]
+            indices, counts = indices[keep], counts[keep]
+
+    order = np.lexsort((indices, -counts))
+    return indices[order], counts[order] / np.float64(len(query))
+
+
+def superminhash_cardinality(values):
+    """
+    Estimated number of distinct features of signatures, `values` of shape (length,) or (n, length).
+
+    For one feature the value of a slot is j + r, j its uniform position in the
+    permutation and r uniform, so values / length are uniform in [0, 1) and the value
+    of a slot is the minimum over n features; -log(1 - value / length) are then
+    exponential with rate n and (length - 1) / their sum estimates n.
+    Empty signatures give 0.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    length = values.shape[-1]
+    empty = values.min(axis=-1) >= length
+
+    u = np.where(values < length, values / length, 0.)
+    total = -np.log1p(-u).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ans = np.where(empty, 0., max(length - 1, 1) / total)
+    return ans if ans.ndim else float(ans)
+
+
+def superminhash_union_cardinality(A, B):
+    """
+    Estimated |A u B| of signatures (rows of A and B, broadcast), the union signature
+    being the element-wise minimum
+    """
+    return superminhash_cardinality(np.minimum(A, B))
+
+
+def superminhash_intersection_cardinality(A, B):
+    """
+    Estimated |A n B| = similarity * |A u B| of signatures (rows of A and B, broadcast)
+    """
+    A, B = np.asarray(A, dtype=np.float64), np.asarray(B, dtype=np.float64)
+    similarity = (A == B).mean(axis=-1)
+    return similarity * superminhash_union_cardinality(A, B)
+
+
+def superminhash_containment(A, B):
+    """
+    Estimated containment |A n B| / |A| of signatures (rows of A and B, broadcast),
+    clipped to [0, 1], 0 when A is empty
+    """
+    intersection = np.asarray(superminhash_intersection_cardinality(A, B))
+    cardinality = np.asarray(superminhash_cardinality(A))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ans = np.where(cardinality > 0, np.minimum(intersection / cardinality, 1.), 0.)
+    return ans if ans.ndim else float(ans)
+
+
+_POPCOUNT_TABLE = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
+def popcount64(x):
+    """
+    number of set bits of every item of an uint64 array (same shape, uint8)
+    """
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _POPCOUNT_TABLE[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def fingerprint_words(value, length):
+    """
+    fingerprint `value` (int) as a list of (length + 63) // 64 uint64 words, lowest word first
+    """
+    return [(value >> (64 * w)) & _MASK64 for w in range((length + 63) // 64)]
+
+
+def words_value(words):
+    """
+    fingerprint (int) of its uint64 `words`, lowest word first (inverse of `fingerprint_words`)
+    """
+    return long(int.from_bytes(np.asarray(words, dtype='<u8').tobytes(), 'little'))
+
+
+def fingerprint_matrix(values, length):
+    """
+    fingerprints `values` (ints, Simhash or rows of words) as an uint64 array of
+    shape (n, (length + 63) // 64), lowest word first
+    """
+    words = (length + 63) // 64
+    if isinstance(values, np.ndarray):
+        return np.asarray(values, dtype=np.uint64).reshape(-1, words)
+    rows = [getattr(x, 'value', x) for x in values]
+    return np.array([fingerprint_words(int(x), length) if isinstance(x, (int, long, np.integer)) else
+                     np.asarray(x, dtype=np.uint64).reshape(words) for x in rows], dtype=np.uint64).reshape(-1, words)
+
+
+def hamming_distances(query, fingerprints):
+    """
+    Hamming distances between the fingerprint `query` (uint64 words) and every row
+    of `fingerprints` (uint64 array of shape (n, words))
+    """
+    fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+    query = np.asarray(query, dtype=np.uint64).reshape(1, -1)
+    return popcount64(fingerprints.reshape(-1, query.shape[1]) ^ query).sum(axis=1, dtype=np.int64)
+
+
+def block_bits(fingerprints, offset, width):
+    """
+    bits offset..offset + width (width at most 64) of every row of `fingerprints`
+    (uint64 array of shape (n, words)) as an uint64 array, blocks may span two words
+    """
+    word, shift = divmod(offset, 64)
+    part = fingerprints[:, word] >> np.uint64(shift)
+    if shift and shift + width > 64 and word + 1 < fingerprints.shape[1]:
+        part = part | (fingerprints[:, word + 1] << np.uint64(64 - shift))
+    if width < 64:
+        part = part & np.uint64((1 << width) - 1)
+    return part
+
+
+def bit_count(x):
+    """
+    number of set bits of the non-negative int `x`
+    """
+    return bin(x).count('1')
+
+
+if hasattr(int, 'bit_count'):
+    bit_count = int.bit_count
+
+
+def hamming_search(query, fingerprints, k, chunksize=None):
+    """
+    Fingerprints within Hamming distance `k` of `query`, brute force.
+
+    `query`        : fingerprint, int or array of uint64 words (lowest word first)
+    `fingerprints` : uint64 array of shape (n,) or (n, words) for lengths above 64 bits,
+                     might be a np.memmap, it is read by chunks
+
+    return (indices, distances) sorted by increasing index
+    """
+    if not isinstance(fingerprints, np.ndarray):
+        fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+    single = fingerprints.ndim == 1
+    words = 1 if single else fingerprints.shape[1]
+    if isinstance(query, (int, long)):
+        query = fingerprint_words(query, 64 * words)
+    query = np.array(query, dtype=np.uint64, ndmin=1)
+    if len(query) != words:
+        raise ValueError('fingerprints not of same length, {0} and {1} words'.format(len(query), words))
+    if chunksize is None:
+        chunksize = SIMILARITY_CHUNKSIZE
+
+    indices, distances = [], []
+    for start in range(0, len(fingerprints), chunksize):
+        chunk = np.asarray(fingerprints[start:start + chunksize], dtype=np.uint64)
+        if single:
+            chunk = chunk[:, None]
+        dist = popcount64(chunk ^ query).sum(axis=1, dtype=np.int64)
+        found = np.flatnonzero(dist <= k)
+        indices.append(found + start)
+        distances.append(dist[found])
+
+    if not indices:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(indices), np.concatenate(distances)
+
+
+def superminhash_lsh_params(threshold, length, false_positive_weight=0.5, false_negative_weight=0.5):
+    """
+    Number of bands `b` and rows per band `r` (b * r <= length) for a LSH banding index.
+
+    Two signatures with similarity s share at least one band with probability
+    1 - (1 - s ** r) ** b; the pair minimizing the weighted sum of the false positive
+    area (below `threshold`) and false negative area (above it) of this curve is chosen.
+
+    return (b, r)
+    """
+    if not 0. < threshold < 1.:
+        raise ValueError('threshold must be in (0, 1), got {0}'.format(threshold))
+
+    def area(y, x):
+        return np.sum((y[1:] + y[:-1]) * np.diff(x)) / 2.
+
+    below = np.linspace(0., threshold, 256)
+    above = np.linspace(threshold, 1., 256)
+
+    best, params = None, None
+    for b in range(1, length + 1):
+        for r in range(1, length // b + 1):
+            false_positive = area(1. - (1. - below ** r) ** b, below)
+            false_negative = area((1. - above ** r) ** b, above)
+            error = false_positive_weight * false_positive + false_negative_weight * false_negative
+            if best is None or error < best:
+                best, params = error, (b, r)
+
+    return params
+
+
+def band_hashes(matrix, bands, rows):
+    """
+    64-bit keys of the bands of the signatures, uint64 array of shape (n, bands):
+    band x covers the values [x * rows, (x + 1) * rows) of each row of `matrix`
+    """
+    bits = np.atleast_2d(np.asarray(matrix, dtype=np.float64)).view(np.uint64)
+    keys = np.empty((len(bits), bands), dtype=np.uint64)
+    for x in range(bands):
+        h = np.full(len(bits), x, dtype=np.uint64)
+        for column in range(x * rows, (x + 1) * rows):
+            h = splitmix64(h + bits[:, column])
+        keys[:, x] = h
+    return keys
+
+
+_REG_CACHE = {}
+
+
+def _compile_reg(reg):
+    """
+    compiled regexp of `reg` (cached by pattern), regexp objects are returned as is
+    """
+    if not isinstance(reg, basestring):
+        return reg
+    compiled = _REG_CACHE.get(reg)
+    if compiled is None:
+        compiled = _REG_CACHE[reg] = re.compile(reg, re.U)
+    return compiled
+
 
 def _slide(content, width=4):
-    return [content[i:i + width] for i in range(max(len(content) - width + 1, 1))]
+    return list(_iter_slide(content, width))
+
+
+def _iter_slide(content, width=4):
+    for i in range(max(len(content) - width + 1, 1)):
+        yield content[i:i + width]
+
+
+def _words(content, reg=r'[\w\u4e00-\u9fcc]+'):
+    if sys.version_info[0] >= 3:
+        ret = content.lower()
+    else:
+        ret = content.decode('utf-8').lower()
+
+    if not reg is None:
+        return _compile_reg(reg).findall(ret)
+    return ret.split()
 
 
 def _tokenize(content, reg=r'[\w\u4e00-\u9fcc]+', slide_width=4, slide_words_delimiter=' '):
@@ -34,26 +983,62 @@ def _tokenize(content, reg=r'[\w\u4e00-\u9fcc]+', slide_width=4, slide_words_del
                is to specify reg=re.compile(r'\w', re.UNICODE))
     '''
 
-    if sys.version_info[0] >= 3:
-        ret = content.lower()
-    else:
-        ret = content.decode('utf-8').lower()
-
-    if not reg is None:
-        ret = re.findall(reg, ret, re.U)
-    else:
-        ret = ret.replace('    ', ' ').replace('   ', ' ').replace('  ', ' ').split()
+    ret = _words(content, reg)
 
     if isinstance(slide_width, int):
-        ret = _slide(('{0}'.format(slide_words_delimiter)).join(ret), width=slide_width)
+        ret = _slide(slide_words_delimiter.join(ret), width=slide_width)
 
     return ret
 
 
 def build_by_text(content, reg=r'[\w\u4e00-\u9fcc]+', tokenize_slide_width=4, slide_words_delimiter=''):
+    """
+    shingle -> count of `content`, counted in one pass while the shingles are produced
+    """
+    words = _words(content, reg)
+    if isinstance(tokenize_slide_width, int):
+        return collections.Counter(_iter_slide(slide_words_delimiter.join(words), tokenize_slide_width))
+    return collections.Counter(words)
+
+
+def shingle_hashes(content, reg=r'[\w\u4e00-\u9fcc]+', tokenize_slide_width=4, slide_words_delimiter=''):
+    """
+    Hashed shingles of `content` without building the shingle strings.
+
+    The shingles are the ones of `build_by_text`; a shingle of code points c_0 .. c_n-1
+    gets the id h_n with h_0 = splitmix64(n * GAMMA), h_j+1 = splitmix64((h_j ^ c_j) + GAMMA),
+    computed for all the positions of the text at once. Words (no sliding) are
+    hashed by `splitmix64_hash_many`.
+
+    return (ids, counts): sorted unique uint64 ids and their int64 counts,
+    the ids can be pushed as feature hashes (`superminhash_push_hashes`)
+    """
+    words = _words(content, reg)
+    if not isinstance(tokenize_slide_width, int):
+        ids, counts = np.unique(splitmix64_hash_many(words)[:, 0], return_counts=True)
+        return ids, counts.astype(np.int64)
 
-    features = _tokenize(content, reg=reg, slide_width=tokenize_slide_width, slide_words_delimiter=slide_words_delimiter)
-    return {k:sum(1 for _ in g) for k, g in groupby(sorted(features))}
+    text = slide_words_delimiter.join(words)
+    points = np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.uint64)
+    width = min(tokenize_slide_width, len(points))
+    count = max(len(points) - tokenize_slide_width + 1, 1)
+
+    ids = splitmix64(np.full(count, width, dtype=np.uint64) * _SPLITMIX64_GAMMA)
+    for j in range(width):
+        ids = splitmix64((ids ^ points[j:j + count]) + _SPLITMIX64_GAMMA)
+
+    ids, counts = np.unique(ids, return_counts=True)
+    return ids, counts.astype(np.int64)
+
+
+def get_features(value_in, tokenize_args):
+    """
+    features of a document: `value_in` is tokenized by `build_by_text` when it is a string,
+    otherwise it is returned as is
+    """
+    if isinstance(value_in, basestring):
+        return build_by_text(unicode(value_in), **tokenize_args)
+    return value_in
 
 
 def get_value(value_in, hash_type, build_by_features,
@@ -62,10 +1047,10 @@ def get_value(value_in, hash_type, build_by_features,
 
     if isinstance(value_in, type(hash_type)):
         if type(hash_type).__name__ == 'Simhash':
-            value_out = (value_in.value, copy.deepcopy(value_in.v), copy.deepcopy(value_in.masks))
+            value_out = (value_in.value, None if value_in.v is None else value_in.v.copy(), value_in.masks)
         elif type(hash_type).__name__ == 'Superminhash':
-            value_out = (copy.deepcopy(value_in.values), copy.deepcopy(value_in.q), copy.deepcopy(value_in.p)\
-                             , copy.deepcopy(value_in.b), value_in.i, value_in.a)
+            value_out = (value_in.values.copy(), value_in.q.copy(), value_in.p.copy(),
+                         value_in.b.copy(), value_in.i, value_in.a)
         else:
             raise Exception('Bad parameter with type.__name__ {0}'.format(type(value_in).__name__))
     elif isinstance(value_in, basestring):
@@ -73,7 +1058,7 @@ def get_value(value_in, hash_type, build_by_features,
               build_by_features(
                 build_by_text(unicode(value_in), **tokenize_args)
             , **kwargs)
-    elif isinstance(value_in, collections.Iterable):
+    elif isinstance(value_in, Iterable):
         value_out = build_by_features(value_in, **kwargs)
     elif isinstance(value_in, long):
         if type(hash_type).__name__ == 'Simhash':
@@ -86,6 +1071,70 @@ def get_value(value_in, hash_type, build_by_features,
     return value_out
 
 
+def simhash_hash_features(features, hash_function, length):
+    """
+    Hash bits and weights of Simhash features.
+
+    `features` : list of tokens (weight 1) or of (token, weight) tuples
+
+    return (bits, weights): bits is an uint8 array of shape (len(features), length),
+    bits[f, i] is the bit i of the hash of the feature f, weights the array of the weights
+    """
+    words = (length + 63) // 64
+    tokens, weights = [], []
+    for feature in features:
+        if isinstance(feature, basestring):
+            tokens.append(feature.encode('utf-8'))
+            weights.append(1)
+        else:
+            assert isinstance(feature, Iterable)
+            tokens.append(feature[0].encode('utf-8'))
+            weights.append(feature[1])
+
+    if isinstance(hash_function, HashFunction):
+        hashes = hash_function.many(tokens, words)
+    else:
+        hashes = [fingerprint_words(hash_function(token), length) for token in tokens]
+    hashes = np.array(hashes, dtype='<u8').reshape(-1, words)
+    bits = np.unpackbits(hashes.view(np.uint8), axis=1, bitorder='little')[:, :length]
+
+    weights = np.array(weights)
+    if weights.dtype.kind not in 'iuf':
+        weights = weights.astype(np.float64)
+    return bits, weights
+
+
+def simhash_push_features(features, hash_function, v, length):
+    """
+    Adds the weights of `features` to the accumulator `v` (numpy array of `length` sums):
+    v[i] += w if bit i of the feature hash is set, -w otherwise, for all the features at once
+    """
+    bits, weights = simhash_hash_features(features, hash_function, length)
+    if len(weights):
+        v = v + (2 * np.dot(weights, bits) - weights.sum())
+    return v
+
+
+def simhash_value(v):
+    """
+    fingerprint (int) of the accumulator `v`: bit i is set when v[i] > 0
+    """
+    return long(int.from_bytes(np.packbits(np.asarray(v) > 0, bitorder='little').tobytes(), 'little'))
+
+
+_SIMHASH_MASKS = {}
+
+
+def simhash_masks(length):
+    """
+    bit masks 1 << i of the `length` bits, one tuple shared by all the fingerprints of `length`
+    """
+    masks = _SIMHASH_MASKS.get(length)
+    if masks is None:
+        masks = _SIMHASH_MASKS.setdefault(length, tuple(1 << i for i in range(length)))
+    return masks
+
+
 def simhash_build_by_features(features, length, hash_function, push_function):
     """
     `features`
@@ -95,41 +1144,233 @@ def simhash_build_by_features(features, length, hash_function, push_function):
 
     `length` : int
                is the dimensions of fingerprints
+
+    `push_function` : pushes a list of features into the accumulator
+               push_function(features, hash_function, v, masks, length, calc)
     """
-    v = [0] * length
-    masks = [1 << i for i in range(length)]
+    v = np.zeros(length, dtype=np.int64)
+    masks = simhash_masks(length)
     if isinstance(features, dict):
         features = features.items()
-    elif isinstance(features, zip):
-        features = list(features)
 
-    nb_calc = len(features) - 1
-    for i, feature in enumerate(features):
-        value, v = push_function(feature, hash_function, v, masks, length, calc = nb_calc==i)
+    value, v = push_function(list(features), hash_function, v, masks, length, calc=True)
 
     return value, v, masks
 
 
-def superminhash_build_by_features(features, length, hash_function, push_function):
+def superminhash_new_state(length):
+    """
+    Empty Superminhash state (values, q, p, b, i, a) as contiguous typed arrays:
+        values float64, q int64, p uint16, b int64
+    """
+    if not 0 < length <= np.iinfo(np.uint16).max + 1:
+        raise ValueError('length must be in 1..65536, got {0}'.format(length))
 
-    values = [MAX_UINT32] * length  # float64
-    q = [-1] * length  # int64
-    p = list(range(length))  # uint16
-    b = [0] * (length - 1) + [np.int64(length)]  # int64
+    values = np.full(length, MAX_UINT32, dtype=np.float64)
+    q = np.full(length, -1, dtype=np.int64)
+    p = np.arange(length, dtype=np.uint16)
+    b = np.zeros(length, dtype=np.int64)
+    b[-1] = length
     i = 0  # int64
     a = length - 1  # uint16
 
+    return values, q, p, b, i, a
+
+
+def superminhash_build_by_features(features, length, hash_function, push_function, weighted=False):
+    """
+    `features`
+               might be a list of tokens, a list of (token, weight) tuples or
+               a token -> weight dict, weights are ignored unless `weighted`
+               (tokens then have a weight of 1)
+
+    `push_function` : pushes a list of features into the state
+               push_function(features, values, q, p, b, i, a, hash_function)
+    """
+    values, q, p, b, i, a = superminhash_new_state(length)
+
+    if weighted:
+        features = list(zip(*superminhash_weighted_features(features)))
+    else:
+        features = superminhash_features(features)
+
+    return push_function(features, values, q, p, b, i, a, hash_function)
+
+
+def superminhash_features(features):
+    """
+    list of the tokens of `features`, weights of (token, weight) tuples and dicts are dropped
+    """
     if isinstance(features, dict):
         features = features.items()
 
-    if sys.version_info[0] >= 3 and isinstance(features, dict_items):
-        features = (x[0] for x in features.__iter__())
-    elif isinstance(features, zip):
-        features = (x[0] for x in features)
-    elif isinstance(features[0], tuple):
-        features = (x[0] for x in features)
+    return [x[0] if isinstance(x, tuple) else x for x in features]
 
-    for feature in features:
-        values, q, p, b, i, a = push_function(feature, values, q, p, b, i, a, hash_function)
 
-    return values, q, p, b, i, a
+def superminhash_weighted_features(features):
+    """
+    (tokens, weights) of `features`: a list of tokens (weight 1), of (token, weight)
+    tuples or a token -> weight dict; weights as a float64 array
+    """
+    if isinstance(features, dict):
+        features = features.items()
+
+    tokens, weights = [], []
+    for x in features:
+        if isinstance(x, basestring):
+            tokens.append(x)
+            weights.append(1.)
+        else:
+            tokens.append(x[0])
+            weights.append(x[1])
+    return tokens, np.array(weights, dtype=np.float64)
+
+
+STORE_MAGIC = b'SMHSTORE'
+STORE_VERSION = 1
+_STORE_ALIGN = 64
+
+
+def _align(x):
+    return (x + _STORE_ALIGN - 1) // _STORE_ALIGN * _STORE_ALIGN
+
+
+def same_hash_function(a, b):
+    """
+    True when the hash functions `a` and `b` (names, backends or callables) hash alike:
+    same registered name, or else the same callable
+    """
+    if a is b:
+        return True
+    a_name, b_name = hash_function_name(a), hash_function_name(b)
+    if a_name is not None and b_name is not None:
+        return a_name == b_name
+    return getattr(a, 'function', a) == getattr(b, 'function', b)
+
+
+def hash_function_name(hash_function):
+    """
+    registered name of `hash_function` (None for custom callables), recorded in the store headers
+    """
+    if isinstance(hash_function, basestring):
+        return hash_function
+    return getattr(hash_function, 'name', None)
+
+
+def write_store(path, header, arrays):
+    """
+    Writes a versioned binary store:
+        STORE_MAGIC, uint32 version, uint32 size of the header, the header as utf-8 JSON,
+        then the `arrays` (dict name -> numpy array), each aligned to 64 bytes.
+    The header records `header` (kind, length, k, hash function, ...) and the dtype,
+    shape and offset of every array, so that they can be memory mapped by `read_store`.
+
+    The store is written to a temporary file of the same directory then moved to `path`
+    (os.replace), so that the indexes still memory mapping a previous store keep reading it.
+    """
+    arrays = dict(arrays)
+    meta = dict(header)
+    meta['arrays'] = {}
+    offset = 0
+    for name in sorted(arrays):
+        a = np.ascontiguousarray(arrays[name])
+        arrays[name] = a
+        meta['arrays'][name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset = _align(offset + a.nbytes)
+
+    encoded = json.dumps(meta, sort_keys=True).encode('utf-8')
+    start = _align(len(STORE_MAGIC) + 8 + len(encoded))
+
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(STORE_MAGIC)
+            f.write(struct.pack('<II', STORE_VERSION, len(encoded)))
+            f.write(encoded)
+            for name in sorted(arrays):
+                f.write(b'\0' * (start + meta['arrays'][name]['offset'] - f.tell()))
+                arrays[name].tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, os.stat(path).st_mode & 0o7777 if os.path.exists(path) else 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_store(path, mmap=True):
+    """
+    Reads a store written by `write_store`
+    return (header, arrays), the arrays are read-only np.memmap when `mmap`
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+            raise ValueError('{0} is not a superminhash store'.format(path))
+        version, size = struct.unpack('<II', f.read(8))
+        if version > STORE_VERSION:
+            raise ValueError('{0} has store version {1}, only {2} is supported'.format(path, version, STORE_VERSION))
+        header = json.loads(f.read(size).decode('utf-8'))
+    start = _align(len(STORE_MAGIC) + 8 + size)
+
+    arrays = {}
+    for name, spec in header.pop('arrays').items():
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+        if mmap and int(np.prod(shape)):
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + spec['offset'], shape=shape)
+        else:
+            count = int(np.prod(shape))
+            arrays[name] = np.fromfile(path, dtype=dtype, count=count, offset=start + spec['offset']).reshape(shape)
+    return header, arrays
+
+
+def pack_ids(ids):
+    """
+    obj_ids as store arrays: 'ids' int64 when they are all ints, else the utf-8
+    encoded strings concatenated in 'id_data' (uint8) with their 'id_offsets' (int64)
+    """
+    ids = list(ids)
+    if all(isinstance(x, (int, long)) and not isinstance(x, bool) for x in ids):
+        return {'ids': np.array(ids, dtype=np.int64)}
+    if not all(isinstance(x, basestring) for x in ids):
+        raise ValueError('obj_ids must be all strings or all integers to be stored')
+
+    encoded = [x.encode('utf-8') for x in ids]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return {'id_data': np.frombuffer(b''.join(encoded), dtype=np.uint8), 'id_offsets': offsets}
+
+
+class StoredIds(object):
+    """
+    Read-only sequence of the obj_ids packed by `pack_ids`, decoded on access
+    """
+
+    __slots__ = ('ids', 'data', 'offsets')
+
+    def __init__(self, arrays):
+        self.ids = arrays.get('ids')
+        self.data = arrays.get('id_data')
+        self.offsets = arrays.get('id_offsets')
+
+    def __len__(self):
+        if self.ids is not None:
+            return len(self.ids)
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(len(self)))]
+        if self.ids is not None:
+            return int(self.ids[i])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('id index out of range')
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
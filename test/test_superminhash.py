@@ -1,7 +1,19 @@
 # -*- coding: utf-8 -*-
 from unittest import main, TestCase
 
-from superminhash import Simhash, SimhashIndex, Superminhash
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from superminhash import Simhash, SimhashBucket, SimhashIndex, Superminhash, SuperminhashLSHIndex, similarity_matrix, \
+    top_k, hamming_search, sign_corpus, save_signatures, load_signatures
+from superminhash.utlilits import MAX_UINT32, superminhash_signature_matrix, superminhash_lsh_params, \
+    get_hash_function, md5_hash, build_by_text, shingle_hashes, splitmix64, superminhash_cardinality, \
+    superminhash_containment, LRUCache, IndexMetrics, words_value, hamming_distances
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 
@@ -20,6 +32,53 @@ class TestSimhash(TestCase):
 
         self.assertNotEqual(Simhash('1').distance(Simhash('2')), 0)
 
+    def test_push(self):
+        features = [('f%d' % i, i % 3 + 1) for i in range(50)]
+        sh = Simhash(features, length=128)
+
+        sh2 = Simhash(features[:1], length=128)
+        for feature in features[1:]:
+            sh2.push(feature)
+
+        self.assertEqual(sh.value, sh2.value)
+        self.assertEqual(sh.v.tolist(), sh2.v.tolist())
+
+    def test_hash_functions(self):
+        self.assertEqual(Simhash(['aaa', 'bbb'], hash_function='md5').value, Simhash(['aaa', 'bbb']).value)
+        self.assertEqual(Simhash(['aaa', 'bbb'], hash_function=md5_hash).value, Simhash(['aaa', 'bbb']).value)
+
+        splitmix64 = get_hash_function('splitmix64')
+        tokens = [b'', b'a', b'a\x00', b'abcdefgh', b'abcdefghi', u'\u4f60\u597d'.encode('utf-8')]
+        hashes = splitmix64.many(tokens, 2)
+        self.assertEqual(len(set(hashes[:, 0].tolist())), len(tokens))
+        self.assertEqual([splitmix64.many([x], 2).tolist()[0] for x in tokens], hashes.tolist())
+        self.assertEqual(splitmix64(tokens[3]), int(hashes[3, 0]))
+
+        tokens += [b'x' * 1000, b'abcdefghij']
+        hashes = splitmix64.many(tokens, 2)
+        self.assertEqual([splitmix64.many([x], 2).tolist()[0] for x in tokens], hashes.tolist())
+
+        sh = Simhash(u'How are you? I AM fine. Thanks. And you?', length=128, hash_function='splitmix64')
+        sh2 = Simhash(u'How are you? I AM fine. Thanks. And you?', length=128, hash_function=splitmix64.function)
+        self.assertEqual(sh.value & (2 ** 64 - 1), sh2.value)
+        self.assertGreater(sh.value, 2 ** 64)
+
+        self.assertRaises(ValueError, Simhash, ['aaa'], hash_function='nope')
+
+    def test_hamming_search(self):
+        shs = [Simhash(s) for s in ('aa', 'aaa', 'aaaa', 'aaaab', 'aaaaabb', 'aaaaabbb')]
+        fingerprints = np.array([sh.value for sh in shs], dtype=np.uint64)
+        for k in (0, 20, 32, 64):
+            indices, distances = hamming_search(shs[2].value, fingerprints, k, chunksize=4)
+            expected = [i for i, sh in enumerate(shs) if sh.distance(shs[2]) <= k]
+            self.assertEqual(indices.tolist(), expected)
+            self.assertEqual(distances.tolist(), [shs[i].distance(shs[2]) for i in expected])
+
+        long_shs = [Simhash(s, length=128) for s in ('aa', 'aaa', 'aaaa')]
+        words = np.array([[sh.value & (2 ** 64 - 1), sh.value >> 64] for sh in long_shs], dtype=np.uint64)
+        self.assertEqual(hamming_search(long_shs[0].value, words, 128)[1].tolist(),
+                         [sh.distance(long_shs[0]) for sh in long_shs])
+
     def test_chinese(self):
         self.maxDiff = None
 
@@ -43,6 +102,31 @@ class TestSimhash(TestCase):
                 if i != j:
                     self.assertNotEqual(sh1, sh2)
 
+    def test_build_many(self):
+        docs = [u'How are you? I AM fine. Thanks. And you?', ['aaa', 'bbb'], {'aaa': 1, 'ccc': 2}]
+        values = Simhash.build_many(docs)
+        self.assertEqual(values.dtype, np.uint64)
+        self.assertEqual([int(x) for x in values], [Simhash(doc).value for doc in docs])
+
+    def test_wide(self):
+        docs = [u'How are you? I AM fine. Thanks. And you?', ['aaa', 'bbb'], {'aaa': 1, 'ccc': 2}]
+        for length in (128, 256):
+            values = Simhash.build_many(docs, length=length)
+            self.assertEqual(values.shape, (3, length // 64))
+            simhashes = [Simhash(doc, length=length, compact=True) for doc in docs]
+            self.assertEqual(values.tolist(), [sh.words.tolist() for sh in simhashes])
+            self.assertEqual(words_value(values[1]), simhashes[1].value)
+
+            self.assertIsNone(simhashes[0].v)
+            self.assertRaises(ValueError, simhashes[0].push, 'aaa')
+            self.assertIs(Simhash(docs[0], length=length).masks, Simhash(docs[1], length=length).masks)
+            self.assertEqual(simhashes[0].distance(values[1]), simhashes[0].distance(simhashes[1]))
+            self.assertEqual(hamming_distances(values[0], values).tolist(),
+                             [simhashes[0].distance(x) for x in simhashes])
+
+        values = Simhash.build_many(docs)
+        self.assertEqual(Simhash(docs[0]).distance(values[1]), Simhash(docs[0]).distance(Simhash(docs[1])))
+
     def test_sparse_features(self):
         data = [
             u'How are you? I Am fine. blar blar blar blar blar Thanks.',
@@ -77,6 +161,115 @@ class TestSimhash(TestCase):
                             Simhash(data[0]).value)
 
 
+class TestShingles(TestCase):
+
+    def test_build_by_text(self):
+        text = u'How are you? I AM fine. Thanks. And you? \u4f60\u597d'
+        features = build_by_text(text)
+        self.assertEqual(features['howa'], 1)
+        self.assertEqual(features['ouia'], 1)
+        self.assertEqual(features['andy'], 1)
+        self.assertEqual(sum(features.values()), len(u'howareyouiamfinethanksandyou\u4f60\u597d') - 3)
+        self.assertEqual(dict(build_by_text(u'ab')), {u'ab': 1})
+        self.assertEqual(dict(build_by_text(u'a b a', tokenize_slide_width=None)), {u'a': 2, u'b': 1})
+        self.assertEqual(build_by_text(text, reg=re.compile(r'\w+', re.U)), build_by_text(text, reg=r'\w+'))
+
+    def test_shingle_hashes(self):
+        def shingle_id(shingle):
+            h = splitmix64(np.array([len(shingle)], dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+            for c in shingle:
+                h = splitmix64((h ^ np.uint64(ord(c))) + np.uint64(0x9E3779B97F4A7C15))
+            return int(h[0])
+
+        for text in (u'How are you? I AM fine. Thanks. And you? blar blar blar', u'ab', u''):
+            features = build_by_text(text)
+            ids, counts = shingle_hashes(text)
+            self.assertEqual(dict(zip(ids.tolist(), counts.tolist())),
+                             dict((shingle_id(k), v) for k, v in features.items()))
+
+    def test_build_many(self):
+        docs = [u'How are you? I AM fine. Thanks. And you? blar blar blar',
+                u'How are you? I am fine. Thanks. And you? blar blar blar', ['aaa', 'bbb']]
+        matrix = Superminhash.build_many(docs, shingle_ids=True)
+        for doc, row in zip(docs[:2], matrix):
+            ids, counts = shingle_hashes(doc)
+            self.assertEqual(row.tolist(), superminhash_signature_matrix(ids, [len(ids)], 64)[0].tolist())
+        self.assertEqual(matrix[2].tolist(), Superminhash(docs[2]).values.tolist())
+        self.assertEqual(similarity_matrix(matrix[0], matrix[1])[0, 0], 1.)
+
+        ids, counts = shingle_hashes(docs[0])
+        weighted = Superminhash.build_many(docs[:1], weighted=True, shingle_ids=True)
+        self.assertEqual(weighted.tolist(),
+                         superminhash_signature_matrix(ids, [len(ids)], 64, weights=counts).tolist())
+
+
+class TestCache(TestCase):
+    docs = [u'How are you? I Am fine. blar blar blar blar blar Thanks.',
+            u'How are you i am fine. blar blar blar blar blar than',
+            ['aaa', 'bbb'],
+            u'How are you? I Am fine. blar blar blar blar blar Thanks.']
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual((cache.get('b'), cache.get('a'), cache.get('c')), (None, 1, 3))
+        self.assertEqual(cache.info(), {'hits': 3, 'misses': 1, 'size': 2, 'maxsize': 2})
+        self.assertRaises(ValueError, LRUCache, 0)
+
+    def test_simhash(self):
+        cache = LRUCache()
+        shs = [Simhash(doc, cache=cache) for doc in self.docs]
+        self.assertEqual([sh.value for sh in shs], [Simhash(doc).value for doc in self.docs])
+        self.assertGreater(cache.hits, 0)
+
+        long_sh = Simhash(self.docs[0], length=128, cache=cache)
+        self.assertEqual(long_sh.value, Simhash(self.docs[0], length=128).value)
+
+        doc_cache = LRUCache()
+        values = Simhash.build_many(self.docs, cache=cache, doc_cache=doc_cache)
+        self.assertEqual(values.tolist(), Simhash.build_many(self.docs).tolist())
+        self.assertEqual(doc_cache.info()['size'], 2)
+        self.assertEqual(Simhash.build_many(self.docs[:1], doc_cache=doc_cache).tolist(), values[:1].tolist())
+        self.assertEqual(doc_cache.hits, 1)
+
+        cache, doc_cache = LRUCache(), LRUCache()
+        self.assertEqual(Simhash(self.docs[0], hash_function='splitmix64', cache=cache).value,
+                         Simhash(self.docs[0], hash_function='splitmix64').value)
+        self.assertEqual(len(cache), 0)
+
+        for seed in range(5):
+            function = lambda x, seed=seed: md5_hash(x) ^ seed
+            self.assertEqual(Simhash(self.docs[0], hash_function=function, cache=cache).value,
+                             Simhash(self.docs[0], hash_function=function).value)
+            self.assertEqual(Simhash.build_many(self.docs[:1], hash_function=function, doc_cache=doc_cache).tolist(),
+                             [Simhash(self.docs[0], hash_function=function).value])
+            del function
+
+    def test_superminhash(self):
+        cache = LRUCache()
+        shs = [Superminhash(doc, cache=cache) for doc in self.docs]
+        self.assertEqual([sh.values.tolist() for sh in shs], [Superminhash(doc).values.tolist() for doc in self.docs])
+        self.assertGreater(cache.hits, 0)
+
+        sh = Superminhash(self.docs[2], cache=cache)
+        for feature in ['f%d' % i for i in range(30)] + ['aaa', 'f3']:
+            sh.push(feature)
+        sh2 = Superminhash(self.docs[2] + ['f%d' % i for i in range(30)] + ['aaa', 'f3'])
+        self.assertEqual(sh.values.tolist(), sh2.values.tolist())
+        self.assertEqual(sh.p.tolist(), sh2.p.tolist())
+        self.assertIs(Superminhash(sh).cache, cache)
+
+        doc_cache = LRUCache()
+        matrix = Superminhash.build_many(self.docs, cache=cache, doc_cache=doc_cache)
+        self.assertEqual(matrix.tolist(), Superminhash.build_many(self.docs).tolist())
+        self.assertEqual(Superminhash.build_many(self.docs[1:2], doc_cache=doc_cache).tolist(), matrix[1:2].tolist())
+        self.assertNotEqual(Superminhash.build_many(self.docs[1:2], doc_cache=doc_cache, weighted=True).tolist(),
+                            matrix[1:2].tolist())
+
+
 class TestSimhashIndex(TestCase):
     data = {
         1: u'How are you? I Am fine. blar blar blar blar blar Thanks.',
@@ -110,11 +303,313 @@ class TestSimhashIndex(TestCase):
         dups = self.index.get_near_dups(s1)
         self.assertEqual(len(dups), 3)
 
+    def test_bucket(self):
+        keys = list(self.index.bucket)
+        self.assertTrue(all(isinstance(i, int) and isinstance(c, int) for i, c in keys))
+        self.assertEqual(sum(len(x) for x in self.index.bucket.values()), 4 * (self.index.k + 1))
+
+        self.index.get_near_dups(Simhash(u'something else'))
+        self.assertEqual(list(self.index.bucket), keys)
+
+        for k, v in self.data.items():
+            self.index.delete(str(k), Simhash(v))
+        self.assertEqual(self.index.bucket_size(), 0)
+
+        bucket = SimhashBucket(2)
+        for n in range(6):
+            bucket.add([n, n + 1], str(n))
+        bucket.add([0, 1], '0')
+        bucket.remove([1, 2], '1')
+        bucket.remove([5, 6], '4')
+        self.assertEqual(sorted(bucket.ids), ['0', '2', '3', '4', '5'])
+        self.assertEqual(bucket.near([3, 4], 0), ['3'])
+
+        bucket.extend(np.array([[3, 4], [7, 8], [7, 8], [0, 1]], dtype=np.uint64), ['3', '7', '7', 'x'])
+        self.assertEqual(sorted(bucket.ids), ['0', '2', '3', '4', '5', '7', 'x'])
+        self.assertEqual(len(bucket.values), 2 * len(bucket))
+
+        rng = np.random.RandomState(0)
+        bucket, expected = SimhashBucket(1), set()
+        for _ in range(3000):
+            entry = (int(rng.randint(8)), str(rng.randint(40)))
+            if rng.uniform() < 0.6:
+                bucket.add([entry[0]], entry[1])
+                expected.add(entry)
+            else:
+                bucket.remove([entry[0]], entry[1])
+                expected.discard(entry)
+            self.assertEqual(len(bucket), len(expected))
+        self.assertIsNotNone(bucket.positions)
+        self.assertEqual(set(zip(bucket.values.tolist(), bucket.ids)), expected)
+        self.assertEqual(set(bucket.positions), set(bucket.ids))
+        for obj_id, i in bucket.positions.items():
+            if i >= 0:
+                self.assertEqual((bucket.ids[i], bucket.ids.count(obj_id)), (obj_id, 1))
+
+    def test_permuted_tables(self):
+        objs = [(str(k), Simhash(v)) for k, v in self.data.items()]
+        index = SimhashIndex(objs, k=3, blocks=6, key_blocks=3)
+        self.assertEqual(len(index.tables), 20)
+        self.assertLess(index.expected_candidates(10 ** 6), SimhashIndex([], k=3).expected_candidates(10 ** 6))
+
+        s1 = Simhash(self.data[2])
+        self.assertEqual(sorted(index.get_near_dups(s1)),
+                         sorted(k for k, sh in objs if sh.distance(s1) <= 3))
+
+        self.assertRaises(ValueError, SimhashIndex, objs, k=3, blocks=6, key_blocks=4)
+
+    def test_metrics(self):
+        metrics = IndexMetrics()
+        objs = [(str(k), Simhash(v)) for k, v in self.data.items()]
+        index = SimhashIndex(objs, k=10, metrics=metrics, big_bucket=2)
+        s1 = Simhash(u'How are you i am fine.ablar ablar xyz blar blar blar blar blar blar blar thank')
+
+        with self.assertLogs('simhash', 'WARNING'):
+            dups = index.get_near_dups(s1)
+        first = metrics.summary()['candidates']
+        index.get_near_dups(Simhash(u'something else'))
+
+        summary = metrics.summary()
+        self.assertEqual(summary['queries'], 2)
+        self.assertEqual(summary['matches'], len(dups))
+        self.assertGreaterEqual(summary['candidates'], len(dups))
+        self.assertEqual(sum(summary['candidates_histogram'].values()), 2)
+        self.assertGreaterEqual(summary['key_seconds'], 0)
+
+        stats = index.stats()
+        self.assertEqual(stats['buckets'], index.bucket_size())
+        self.assertEqual(stats['entries'], 4 * 11)
+        self.assertEqual(len(stats['tables']), 11)
+        self.assertEqual(sum(stats['histogram'].values()), stats['buckets'])
+        self.assertEqual(self.index.stats()['entries'], stats['entries'])
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        index.save(os.path.join(tmp, 'index'))
+        mapped = SimhashIndex.load(os.path.join(tmp, 'index'), metrics=metrics)
+        self.assertEqual(dict((k, v) for k, v in mapped.stats().items() if k != 'tables'),
+                         dict((k, v) for k, v in stats.items() if k != 'tables'))
+        mapped.get_near_dups(s1)
+        self.assertEqual(metrics.summary()['queries'], 3)
+        self.assertEqual(metrics.summary()['candidates'], summary['candidates'] + first)
+        del mapped
+
+    def test_add_many(self):
+        index = SimhashIndex((x for x in []), k=10)
+        self.assertEqual(index.add_many(((str(k), v) for k, v in self.data.items()), chunksize=3), 4)
+        self.assertEqual(index.add_many([('1', self.data[1]), ('5', Simhash(self.data[2])),
+                                         ('5', Simhash(self.data[2]).value)]), 3)
+        self.index.add('5', Simhash(self.data[2]))
+
+        self.assertEqual(sorted(index.bucket), sorted(self.index.bucket))
+        for key, dups in index.bucket.items():
+            self.assertEqual(sorted(zip(dups.ids, dups.values)), sorted(zip(self.index.bucket[key].ids,
+                                                                            self.index.bucket[key].values)))
+
+        s1 = Simhash(u'How are you i am fine.ablar ablar xyz blar blar blar blar blar blar blar thank')
+        self.assertEqual(sorted(index.get_near_dups(s1)), sorted(self.index.get_near_dups(s1)))
+
+        for length, k in ((64, 10), (128, 0), (128, 20)):
+            built = SimhashIndex([], length=length, k=k)
+            self.assertEqual(built.add_many(zip(map(str, self.data), Simhash.build_many(self.data.values(),
+                                                                                       length=length))), 4)
+            single = SimhashIndex([(str(k_), Simhash(v, length=length)) for k_, v in self.data.items()],
+                                  length=length, k=k)
+            self.assertEqual(sorted(built.bucket), sorted(single.bucket))
+
+    def test_save_load(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        s1 = Simhash(u'How are you i am fine.ablar ablar xyz blar blar blar blar blar blar blar thank')
+
+        for length, k, blocks in ((64, 10, None), (64, 3, 6), (128, 20, 24)):
+            objs = [(str(k_), Simhash(v, length=length)) for k_, v in self.data.items()]
+            index = SimhashIndex(objs, length=length, k=k, blocks=blocks)
+            path = os.path.join(tmp, 'index')
+            index.save(path, hash_function='md5')
+
+            mapped = SimhashIndex.load(path)
+            self.assertEqual(mapped.hash_function, 'md5')
+            self.assertEqual(mapped.bucket_size(), index.bucket_size())
+            query = Simhash(s1.value if length == 64 else self.data[2], length=length)
+            self.assertEqual(sorted(mapped.get_near_dups(query)), sorted(index.get_near_dups(query)))
+            self.assertEqual(sorted(SimhashIndex.load(path, mmap=False).get_near_dups(query)),
+                             sorted(index.get_near_dups(query)))
+            self.assertEqual(sorted(mapped.to_index().get_near_dups(query)), sorted(index.get_near_dups(query)))
+            self.assertRaises(TypeError, mapped.add, '5', query)
+            self.assertRaises(TypeError, mapped.add_many, [('5', self.data[2])])
+            self.assertRaises(TypeError, mapped._add_values, ['5'], [query.value])
+            del mapped
+
+        index = SimhashIndex([(str(k_), Simhash(v)) for k_, v in self.data.items()], k=10)
+        index.save(path)
+        mapped = SimhashIndex.load(path)
+        dups = sorted(mapped.get_near_dups(s1))
+        mapped.save(path)
+        SimhashIndex([], k=3).save(path)
+        self.assertEqual(sorted(mapped.get_near_dups(s1)), dups)
+        self.assertEqual(SimhashIndex.load(path).get_near_dups(s1), [])
+        self.assertEqual(os.listdir(tmp), ['index'])
+        del mapped
+
+        with open(path, 'wb') as f:
+            f.write(b'not a store')
+        self.assertRaises(ValueError, SimhashIndex.load, path)
+
+    def test_long_fingerprints(self):
+        objs = [(str(k), Simhash(v, length=128)) for k, v in self.data.items()]
+        index = SimhashIndex(objs, length=128, k=20)
+        s1 = Simhash(self.data[2], length=128)
+        self.assertEqual(sorted(index.get_near_dups(s1)),
+                         sorted(k for k, sh in objs if sh.distance(s1) <= 20))
+
+        for length, k, blocks in ((128, 20, None), (128, 20, 24), (256, 1, None)):
+            bulk = SimhashIndex([], length=length, k=k, blocks=blocks)
+            self.assertEqual(bulk.wide_keys, length == 256)
+            bulk.add_many([(k_, v) for k_, v in self.data.items()][:2])
+            bulk.add_many([(k_, Simhash(v, length=length).words) for k_, v in self.data.items()][2:])
+            single = SimhashIndex([(k_, Simhash(v, length=length)) for k_, v in self.data.items()],
+                                  length=length, k=k, blocks=blocks)
+            self.assertEqual(sorted(bulk.bucket), sorted(single.bucket))
+            query = Simhash(self.data[2], length=length)
+            self.assertEqual(sorted(bulk.get_near_dups(query)), sorted(single.get_near_dups(query)))
+
 
 class TestSuperminhash(TestCase):
 
     def test_value(self):
-        self.assertEqual(Superminhash(['aaa', 'bbb'], length=4).values, [0.65485953228894145, 2.0632418997267359, 1.7271384144497892, 1.6527771937318092])
+        self.assertEqual(Superminhash(['aaa', 'bbb'], length=4).values.tolist(),
+                         [1.6458498857888708, 0.643099952655403, 1.8420575670045773, 0.9064013668381281])
+
+    def test_push(self):
+        features = ['f%d' % i for i in range(100)]
+        sh = Superminhash(features)
+
+        np.random.seed(1)
+        sh2 = Superminhash(features[:1])
+        for feature in features[1:]:
+            sh2.push(feature)
+
+        self.assertEqual(sh.values.tolist(), sh2.values.tolist())
+        self.assertEqual(sh.b.tolist(), sh2.b.tolist())
+        self.assertEqual((sh.i, sh.a), (sh2.i, sh2.a))
+
+    def test_merge(self):
+        features = ['f%d' % i for i in range(100)]
+        sh = Superminhash(features)
+        sh1, sh2, sh3 = Superminhash(features[:10]), Superminhash(features[10:60]), Superminhash(features[50:])
+
+        merged = sh1 | sh2
+        self.assertEqual(merged.values.tolist(), Superminhash(features[:60]).values.tolist())
+        self.assertEqual(merged.b.tolist(), Superminhash(features[:60]).b.tolist())
+        self.assertEqual((sh1.i, merged.i), (10, 60))
+        self.assertEqual(sh1.values.tolist(), Superminhash(features[:10]).values.tolist())
+
+        for feature in features[60:]:
+            merged.push(feature)
+        self.assertEqual(merged.values.tolist(), sh.values.tolist())
+        self.assertEqual(merged.a, sh.a)
+
+        union = Superminhash.union_many([sh1, sh2, sh3])
+        self.assertEqual(union.values.tolist(), sh.values.tolist())
+        self.assertEqual(union.i, 110)
+        self.assertTrue(all(0 <= x < 110 for x in union.q.tolist()))
+        self.assertEqual(sh1.i, 10)
+
+        sh1 |= Superminhash([])
+        self.assertEqual(sh1.values.tolist(), Superminhash(features[:10]).values.tolist())
+        self.assertRaises(ValueError, sh1.merge, Superminhash(features, length=32))
+        self.assertRaises(ValueError, sh1.merge, Superminhash(features, hash_function='splitmix64'))
+
+        import pickle
+        restored = pickle.loads(pickle.dumps(sh2))
+        self.assertIs(restored.hash_function, sh2.hash_function)
+        self.assertEqual((Superminhash(features[:10]) | restored).values.tolist(),
+                         Superminhash(features[:60]).values.tolist())
+        self.assertEqual((Superminhash(features[:10], hash_function=md5_hash) | sh2).values.tolist(),
+                         Superminhash(features[:60]).values.tolist())
+
+    def test_cardinality(self):
+        features = ['f%d' % i for i in range(3000)]
+        sh1 = Superminhash(features[:2000], length=256)
+        sh2 = Superminhash(features[1000:], length=256)
+
+        self.assertAlmostEqual(sh1.cardinality() / 2000, 1, delta=0.15)
+        self.assertAlmostEqual(sh1.union_cardinality(sh2) / 3000, 1, delta=0.15)
+        self.assertAlmostEqual(sh1.intersection_cardinality(sh2) / 1000, 1, delta=0.3)
+        self.assertAlmostEqual(sh1.containment(sh2), 0.5, delta=0.15)
+        self.assertEqual(Superminhash(features[:3], length=256).cardinality() <= 3, True)
+        self.assertEqual(Superminhash([]).cardinality(), 0.)
+
+        matrix = Superminhash.build_many([features[:2000], features[1000:], []], length=256)
+        self.assertEqual(superminhash_cardinality(matrix)[:2].tolist(),
+                         [superminhash_cardinality(sh1.values), superminhash_cardinality(sh2.values)])
+        self.assertEqual(superminhash_cardinality(matrix)[2], 0.)
+        self.assertEqual(superminhash_containment(matrix, matrix[0]).tolist(), [1., sh2.containment(sh1), 0.])
+
+    def test_weighted(self):
+        rng = np.random.RandomState(0)
+        tokens = ['f%d' % i for i in range(200)]
+        w1 = dict(zip(tokens[:150], rng.uniform(0.1, 5, 150)))
+        w2 = dict(zip(tokens[50:], rng.uniform(0.1, 5, 150)))
+        jaccard = sum(min(w1.get(x, 0), w2.get(x, 0)) for x in tokens) / \
+            sum(max(w1.get(x, 0), w2.get(x, 0)) for x in tokens)
+
+        sh1 = Superminhash(w1, length=512, weighted=True)
+        sh2 = Superminhash(w2, length=512, weighted=True)
+        self.assertAlmostEqual(sh1.similarity(sh2), jaccard, delta=0.07)
+        self.assertNotAlmostEqual(Superminhash(w1, length=512).similarity(Superminhash(w2, length=512)),
+                                  jaccard, delta=0.07)
+        doubled = Superminhash(dict((k, 2 * v) for k, v in w1.items()), length=512, weighted=True)
+        self.assertAlmostEqual(sh1.similarity(doubled), 0.5, delta=0.07)
+
+        sh3 = Superminhash(list(w1.items())[:1], length=512, weighted=True)
+        for feature in list(w1.items())[1:]:
+            sh3.push(feature)
+        self.assertEqual(sh3.values.tolist(), sh1.values.tolist())
+        self.assertEqual(Superminhash(sh1).weighted, True)
+
+        matrix = Superminhash.build_many([w1, w2, u'blar blar blar'], length=512, weighted=True)
+        self.assertEqual(matrix[:2].tolist(), [sh1.values.tolist(), sh2.values.tolist()])
+        self.assertEqual(matrix[2].tolist(), Superminhash(u'blar blar blar', length=512, weighted=True).values.tolist())
+
+        merged = Superminhash(dict(list(w1.items())[:70]), length=512, weighted=True) | \
+            Superminhash(dict(list(w1.items())[70:]), length=512, weighted=True)
+        self.assertEqual(merged.values.tolist(), sh1.values.tolist())
+        self.assertRaises(ValueError, sh1.merge, Superminhash(w1, length=512))
+        self.assertRaises(ValueError, sh1.cardinality)
+
+    def test_state(self):
+        sh = Superminhash(['aaa', 'bbb'])
+        self.assertFalse(hasattr(sh, '__dict__'))
+        self.assertEqual([x.dtype for x in (sh.values, sh.q, sh.p, sh.b)],
+                         [np.float64, np.int64, np.uint16, np.int64])
+
+        sh2 = Superminhash(sh)
+        sh2.push('ccc')
+        self.assertEqual((sh.i, sh2.i), (2, 3))
+        self.assertNotEqual(sh.values.tolist(), sh2.values.tolist())
+
+    def test_hash_functions(self):
+        doc = u'How are you? I AM fine. Thanks. And you?'
+        self.assertEqual(Superminhash(doc, hash_function='md5').values.tolist(), Superminhash(doc).values.tolist())
+        self.assertEqual(Superminhash(doc, hash_function='splitmix64').values.tolist(),
+                         Superminhash(doc, hash_function=get_hash_function('splitmix64').function).values.tolist())
+        self.assertEqual(Superminhash.build_many([doc], hash_function='splitmix64')[0].tolist(),
+                         Superminhash(doc, hash_function='splitmix64').values.tolist())
+
+    def test_build_many(self):
+        docs = [u'How are you? I AM fine. Thanks. And you?', ['aaa', 'bbb'], [], {'aaa': 1, 'ccc': 2}]
+        matrix = Superminhash.build_many(docs)
+        self.assertEqual(matrix.shape, (4, 64))
+        self.assertEqual(matrix[2].tolist(), [float(MAX_UINT32)] * 64)
+        for doc, values in zip(docs, matrix):
+            if doc:
+                self.assertEqual(values.tolist(), Superminhash(doc).values.tolist())
+
+        hashes = np.arange(10, dtype=np.uint64)
+        self.assertEqual(superminhash_signature_matrix(hashes, [3, 0, 7], 16, chunksize=4).tolist(),
+                         superminhash_signature_matrix(hashes, [3, 0, 7], 16).tolist())
 
     def test_distance(self):
         sh = Superminhash('How are you? I AM fine. Thanks. And you?')
@@ -126,6 +621,42 @@ class TestSuperminhash(TestCase):
 
         self.assertEqual(Superminhash('1').similarity(Superminhash('2')), 0.)
 
+    def test_similarity_matrix(self):
+        docs = [u'How are you? I Am fine. blar blar blar blar blar Thanks.',
+                u'How are you i am fine. blar blar blar blar blar than',
+                u'This is Superminhash test.']
+        shs = [Superminhash(doc) for doc in docs]
+        matrix = Superminhash.build_many(docs)
+
+        sims = similarity_matrix(matrix, matrix, chunksize=2)
+        self.assertEqual(sims.shape, (3, 3))
+        for i, sh1 in enumerate(shs):
+            for j, sh2 in enumerate(shs):
+                self.assertEqual(sims[i, j], sh1.similarity(sh2))
+
+        indices, scores = top_k(matrix[1], matrix, 2, chunksize=1)
+        self.assertEqual(indices.tolist(), [1, 0])
+        self.assertEqual(scores.tolist(), [1., shs[0].similarity(shs[1])])
+        self.assertEqual(len(top_k(matrix[1], matrix, 10)[0]), 3)
+
+    def test_save_load(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'signatures')
+
+        docs = [u'How are you? I AM fine. Thanks. And you?', ['aaa', 'bbb'], u'\u4f60\u597d']
+        matrix = Superminhash.build_many(docs)
+        for ids in (['a', u'\u4f60', 'c'], [3, 1, 2]):
+            save_signatures(path, ids, matrix, hash_function='md5')
+            stored_ids, stored = load_signatures(path)
+            self.assertEqual(list(stored_ids), ids)
+            self.assertEqual(stored.tolist(), matrix.tolist())
+            self.assertEqual(top_k(matrix[1], stored, 1)[0].tolist(), [1])
+            del stored
+
+        self.assertRaises(ValueError, save_signatures, path, ['a', 1, 'c'], matrix)
+        self.assertRaises(ValueError, save_signatures, path, ['a'], matrix)
+
     def test_chinese(self):
         self.maxDiff = None
 
@@ -147,7 +678,7 @@ class TestSuperminhash(TestCase):
         for i, sh1 in enumerate(shs):
             for j, sh2 in enumerate(shs):
                 if i != j:
-                    self.assertNotEqual(sh1.values, sh2.values)
+                    self.assertNotEqual(sh1.values.tolist(), sh2.values.tolist())
                     self.assertNotEqual(sh1.similarity(sh2), 1)
 
     def test_sparse_features(self):
@@ -181,8 +712,250 @@ class TestSuperminhash(TestCase):
 
         # the sparse and non-sparse features should obviously yield
         # different results
-        self.assertNotEqual(Superminhash(dict_features).values,
-                            Superminhash(data[0]).values)
+        self.assertNotEqual(Superminhash(dict_features).values.tolist(),
+                            Superminhash(data[0]).values.tolist())
+
+
+class TestSignCorpus(TestCase):
+    docs = [u'How are you? I Am fine. blar blar blar blar blar Thanks.',
+            u'How are you i am fine. blar blar blar blar blar than',
+            u'This is Superminhash test.',
+            ['aaa', 'bbb'],
+            u'How are you i am fine. blar blar blar blar blar thank1'] * 3
+
+    def test_superminhash(self):
+        matrix = sign_corpus(self.docs, workers=2, chunksize=4)
+        self.assertEqual(matrix.tolist(), Superminhash.build_many(self.docs).tolist())
+
+    def test_simhash(self):
+        values = sign_corpus(iter(self.docs), kind='simhash', workers=2, chunksize=4, hash_function='splitmix64')
+        self.assertEqual(values.tolist(), Simhash.build_many(self.docs, hash_function='splitmix64').tolist())
+        self.assertRaises(ValueError, sign_corpus, self.docs, kind='minhash')
+
+    def test_simhash_wide(self):
+        values = sign_corpus(self.docs, kind='simhash', length=128, workers=2, chunksize=4)
+        self.assertEqual(values.shape, (len(self.docs), 2))
+        self.assertEqual(values.tolist(), sign_corpus(self.docs, kind='simhash', length=128, workers=1).tolist())
+
+
+class TestSuperminhashLSHIndex(TestCase):
+    data = {
+        1: u'How are you? I Am fine. blar blar blar blar blar Thanks.',
+        2: u'How are you i am fine. blar blar blar blar blar than',
+        3: u'This is Superminhash test.',
+        4: u'How are you i am fine. blar blar blar blar blar thank1',
+    }
+
+    def setUp(self):
+        objs = [(str(k), Superminhash(v)) for k, v in self.data.items()]
+        self.index = SuperminhashLSHIndex(objs, threshold=0.5)
+
+    def test_params(self):
+        self.assertLessEqual(self.index.bands * self.index.rows, 64)
+        self.assertEqual(superminhash_lsh_params(0.5, 64), (self.index.bands, self.index.rows))
+
+    def test_query(self):
+        s1 = Superminhash(u'How are you i am fine. blar blar blar blar blar thank')
+        dups = self.index.query(s1)
+        self.assertEqual(set(x[0] for x in dups), {'1', '2', '4'})
+        self.assertEqual([x[1] for x in dups], sorted([x[1] for x in dups], reverse=True))
+        for obj_id, sim in dups:
+            self.assertEqual(sim, s1.similarity(Superminhash(self.data[int(obj_id)])))
+            self.assertGreaterEqual(sim, 0.5)
+
+        self.index.delete('4', Superminhash(self.data[4]))
+        self.assertNotIn('4', [x[0] for x in self.index.query(s1)])
+
+        self.index.add('4', Superminhash(self.data[4]))
+        self.index.add('4', Superminhash(self.data[4]).values)
+        self.assertEqual(sorted(self.index.query(s1)), sorted(dups))
+        self.assertEqual(self.index.query(Superminhash(self.data[3]), threshold=1.), [('3', 1.)])
+
+        self.index.delete('3', Superminhash(self.data[1]))
+        self.assertEqual(self.index.query(Superminhash(self.data[3]), threshold=1.), [])
+        self.assertNotIn('3', set().union(*self.index.bucket.values()))
+
+    def test_save_load(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'index')
+
+        self.index.save(path)
+        mapped = SuperminhashLSHIndex.load(path)
+        self.assertEqual((mapped.bands, mapped.rows, mapped.threshold), (self.index.bands, self.index.rows, 0.5))
+        self.assertEqual(mapped.bucket_size(), self.index.bucket_size())
+        self.assertRaises(TypeError, mapped.add, '5', Superminhash(self.data[1]))
+        self.assertRaises(TypeError, mapped.add_many, [('5', self.data[1])])
+
+        s1 = Superminhash(u'How are you i am fine. blar blar blar blar blar thank')
+        self.assertEqual(sorted(mapped.query(s1)), sorted(self.index.query(s1)))
+        self.assertEqual(mapped.query(Superminhash(u'something else entirely')), [])
+
+        ids, matrix = self.index.entries()
+        save_signatures(path + '_old', ids, matrix, header={'kind': 'superminhash_lsh_index', 'threshold': 0.5,
+                                                            'bands': mapped.bands, 'rows': mapped.rows})
+        old = SuperminhashLSHIndex.load(path + '_old', chunksize=3)
+        self.assertEqual(sorted(old.query(s1)), sorted(self.index.query(s1)))
+
+        index = mapped.to_index(chunksize=3)
+        self.assertEqual(dict(index.bucket), dict(self.index.bucket))
+        index.delete('4', Superminhash(self.data[4]))
+        self.assertNotIn('4', [x[0] for x in index.query(s1)])
+        del index
+
+    def test_add_many(self):
+        index = SuperminhashLSHIndex(iter([]), threshold=0.5)
+        self.assertEqual(index.add_many(((str(k), v) for k, v in self.data.items()), chunksize=3), 4)
+        self.assertEqual(dict(index.bucket), dict(self.index.bucket))
+
+        s1 = Superminhash(u'How are you i am fine. blar blar blar blar blar thank')
+        self.assertEqual(index.query(s1), self.index.query(s1))
+
+
+class TestConcurrentSimhashIndex(TestCase):
+    data = TestSimhashIndex.data
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from superminhash import ConcurrentSimhashIndex
+
+        from superminhash.benchmark import synthetic_corpus
+
+        objs = [(str(n), Simhash(x)) for n, x in enumerate(synthetic_corpus(400, seed=1))]
+        index = ConcurrentSimhashIndex([], k=3, stripes=8)
+
+        def ingest(part):
+            for obj_id, simhash in part:
+                index.add(obj_id, simhash)
+                index.get_near_dups(simhash)
+            return True
+
+        buckets = len(index.bucket)
+        index.get_near_dups(objs[0][1])
+        self.assertEqual(len(index.bucket), buckets)
+
+        with ThreadPoolExecutor(8) as executor:
+            self.assertTrue(all(executor.map(ingest, [objs[n::8] for n in range(8)])))
+
+        sync = SimhashIndex(objs, k=3)
+        self.assertEqual(sorted(index.bucket_sizes()), sorted(sync.bucket_sizes()))
+        for _, simhash in objs[:50]:
+            self.assertEqual(sorted(index.get_near_dups(simhash)), sorted(sync.get_near_dups(simhash)))
+
+        key = next(iter(index.get_keys(objs[0][1])))
+        dups = index._get_bucket(key)
+        size, rows = len(dups), dups.fingerprints().tolist()
+        index.add('copy', objs[0][1])
+        self.assertIs(index.bucket[key], dups)
+        self.assertEqual(dups.fingerprints()[:size].tolist(), rows)
+        self.assertIn('copy', dups.near([objs[0][1].value], 0))
+        index.delete('copy', objs[0][1])
+        self.assertIsNot(index.bucket[key], dups)
+        self.assertEqual(len(dups), size + 1)
+        self.assertNotIn('copy', index.bucket[key].ids)
+
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda x: index.delete(*x), objs[100:]))
+        self.assertEqual(sorted(index.entries()[0]), sorted(x[0] for x in objs[:100]))
+
+
+class TestShardedIndex(TestCase):
+
+    def test_scatter_gather(self):
+        from superminhash.benchmark import synthetic_corpus
+        from superminhash.sharded import ShardedIndex, shard_of
+
+        docs = synthetic_corpus(200, seed=2)
+        objs = [(str(n), x) for n, x in enumerate(docs)]
+        simhashes = [(obj_id, Simhash(x)) for obj_id, x in objs]
+        sync = SimhashIndex(simhashes, k=3)
+        lsh = SuperminhashLSHIndex([(obj_id, Superminhash(x)) for obj_id, x in objs], threshold=0.5)
+        self.assertEqual(shard_of('12', 4), shard_of(u'12', 4))
+
+        for transport in ('local', 'process'):
+            with ShardedIndex(4, transport=transport, k=3) as index:
+                self.assertEqual(index.add_many(objs[:150], chunksize=64), 150)
+                for obj_id, simhash in simhashes[150:]:
+                    index.add(obj_id, simhash)
+                self.assertEqual(index.query_many(docs[:20]), [index.query(x) for x in docs[:20]])
+                for doc, (_, simhash) in zip(docs[:20], simhashes):
+                    self.assertEqual(sorted(index.query(doc)), sorted(sync.get_near_dups(simhash)))
+
+                fingerprints = Simhash.build_many(docs[:3])
+                self.assertEqual(index.query_many(fingerprints), index.query_many(docs[:3]))
+
+                index.delete('0', docs[0])
+                self.assertNotIn('0', index.query(docs[0]))
+
+            with ShardedIndex(3, kind='superminhash', transport=transport, threshold=0.5) as index:
+                index.add_many(objs[:100])
+                index.add_many((obj_id, Superminhash(x)) for obj_id, x in objs[100:])
+                for doc in docs[:10]:
+                    self.assertEqual(sorted(index.query(doc)), sorted(lsh.query(Superminhash(doc))))
+
+        with ShardedIndex(2, length=128, k=20) as index:
+            wide = Simhash.build_many(docs[:20], length=128)
+            index.add_many(zip(map(str, range(20)), wide))
+            self.assertEqual(sorted(index.query(wide[3])), sorted(index.query(docs[3])))
+            self.assertIn('3', index.query(wide[3]))
+            index.delete('3', wide[3])
+            self.assertNotIn('3', index.query(docs[3]))
+
+        with self.assertRaises(ValueError):
+            ShardedIndex(2, transport='tcp')
+
+
+class TestAsyncDedupIndex(TestCase):
+    data = TestSimhashIndex.data
+
+    def test_query(self):
+        from superminhash.async_index import AsyncDedupIndex
+
+        s1 = u'How are you i am fine.ablar ablar xyz blar blar blar blar blar blar blar thank'
+        sync = SimhashIndex([(str(k), Simhash(v)) for k, v in self.data.items()], k=10)
+
+        async def run():
+            index = AsyncDedupIndex(k=10, window=0.01)
+            await asyncio.gather(*[index.add(str(k), v) for k, v in self.data.items()])
+            batches = index.batches
+
+            queries = [s1, self.data[3], Simhash(self.data[1]), Simhash(self.data[2]).value] * 5
+            results = await asyncio.gather(*[index.query(x) for x in queries])
+            self.assertEqual(index.batches, batches + 1)
+            for doc, dups in zip(queries, results):
+                doc = doc if isinstance(doc, Simhash) else Simhash(doc)
+                self.assertEqual(sorted(dups), sorted(sync.get_near_dups(doc)))
+
+            await index.delete('1', self.data[1])
+            self.assertNotIn('1', await index.query(s1))
+
+            index = AsyncDedupIndex(k=10, window=10., max_batch=2)
+            self.assertEqual(await asyncio.gather(index.query(s1), index.query(s1)), [[], []])
+
+            index = AsyncDedupIndex(k=10, window=0.01)
+            await index.add('1', Simhash.build_many([self.data[1]])[0])
+            results = await asyncio.gather(index.query(self.data[1]), index.query(12.5),
+                                           index.query(Simhash.build_many([self.data[1]])[0]),
+                                           return_exceptions=True)
+            self.assertEqual(results[0], ['1'])
+            self.assertIsInstance(results[1], Exception)
+            self.assertEqual(results[2], ['1'])
+            self.assertEqual(index._queries.batches, 1)
+            return batches
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+
+class TestBenchmark(TestCase):
+
+    def test_run(self):
+        from superminhash.benchmark import run, synthetic_corpus
+
+        self.assertEqual(synthetic_corpus(10, seed=1), synthetic_corpus(10, seed=1))
+        results = run(sizes=(20,), lengths=(64, 128), queries=5)
+        self.assertEqual(len(results), 16)
+        for record in results:
+            self.assertTrue(set(['name', 'docs', 'length', 'seconds', 'throughput', 'peak_memory']) <= set(record))
 
 
 if __name__ == '__main__':